@@ -1,10 +1,53 @@
-from sqlmodel import Session, select, func, delete
-from sqlalchemy.exc import NoResultFound
-from datetime import datetime
+from sqlmodel import select, func, delete, insert, update, col, not_, tuple_
+from sqlalchemy import bindparam, case, literal_column, null
+from sqlalchemy.exc import IntegrityError, NoResultFound
+from datetime import datetime, timedelta
+import logging
+import re
+import sqlite3
+import time
+from copy import copy
+from itertools import islice
+from pathlib import Path
+from threading import Event, RLock, Thread
+from typing import Callable, Iterable, Iterator, NamedTuple, TextIO
 from uuid import UUID
 
-from db import get_engine
-from models import Task
+from backups import (
+    BackupException,
+    backup_to_file,
+    list_snapshots,
+    open_backup,
+    pages_per_step,
+    rotate_snapshots,
+    snapshot_path,
+    snapshots_kept,
+    step_sleep,
+)
+from db import backup_dir, db_file, get_engine, shard_db_url, shard_dir
+from events import TaskEvent, TaskEventKind, TaskEvents
+from instrumentation import Instrumentation, instrumented
+from models import (
+    ArchivedTask,
+    Task,
+    TaskRow,
+    archived_columns,
+    default_list_id,
+    task_fts,
+    task_row_columns,
+)
+from sessions import SessionManager
+from task_queue import TaskQueue
+from transfer import (
+    TransferStats,
+    import_row,
+    read_records,
+    transfer_columns,
+    transfer_formats,
+    write_records,
+)
+
+logger = logging.getLogger("kute_task.api")
 
 
 class TaskException(Exception):
@@ -27,13 +70,436 @@ class InvalidTitle(TaskException):
     pass
 
 
+class InvalidStatus(TaskException):
+    pass
+
+
+class InvalidFormat(TaskException):
+    pass
+
+
+class InvalidImport(TaskException):
+    pass
+
+
+class InvalidListID(TaskException):
+    pass
+
+
+# max ids bound in a single `IN (...)` clause, well under SQLite's variable limit
+ID_CHUNK_SIZE = 500
+
+
+def chunked(items: list, size: int = ID_CHUNK_SIZE):
+    """Yield successive slices of items of at most size elements."""
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def ichunked(items: Iterable, size: int) -> Iterator[list]:
+    """Like chunked() for any iterable, consumed one chunk at a time."""
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class TaskStats(NamedTuple):
+    total: int
+    active: int
+    completed: int
+
+
+# statuses accepted by the listing methods, as shown in the task list tabs
+task_statuses = ("all", "active", "completed")
+
+
+# list ids are also file names, see db.shard_db_url()
+list_id_pattern = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def check_list_id(list_id: str) -> str:
+    if not isinstance(list_id, str) or not list_id_pattern.fullmatch(list_id):
+        raise InvalidListID(
+            f"[Error] invalid list id: {list_id!r}, use 1 to 64 letters, "
+            "digits, - or _"
+        )
+    return list_id
+
+
+def search_query(text: str) -> str:
+    """FTS5 query matching the titles with a word starting with each word
+    of text ("bu mi" finds "buy milk"). Words are quoted so FTS5 operators
+    and punctuation in text are taken literally.
+    """
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+# statements of the single task methods, built once. with bind parameters
+# instead of literal values SQLAlchemy compiles each of them only once
+# (see its compiled cache) and they're not rebuilt on every call
+# (every one of them is scoped to the TaskAPI's list by the task_list param)
+in_list = Task.list_id == bindparam("task_list")
+task_by_id = select(Task).where(Task.id == bindparam("task_id"), in_list)
+next_task_statement = (
+    select(Task)
+    .where(in_list, Task.is_completed == False)
+    .order_by(Task.last_deferred.asc())
+    .limit(1)
+)
+count_statement = select(func.count()).select_from(Task).where(in_list)
+update_title_statement = (
+    update(Task)
+    .where(Task.id == bindparam("task_id"), in_list)
+    .values(title=bindparam("new_title"))
+    .returning(Task)
+)
+defer_statement = (
+    update(Task)
+    .where(Task.id == bindparam("task_id"), in_list)
+    .values(last_deferred=bindparam("now"))
+    .returning(Task)
+)
+toggle_complete_statement = (
+    update(Task)
+    .where(Task.id == bindparam("task_id"), in_list)
+    .values(
+        is_completed=not_(Task.is_completed),
+        completed_at=case(
+            (Task.is_completed, null()),
+            else_=bindparam("now", type_=Task.completed_at.type),
+        ),
+    )
+    .returning(Task)
+)
+delete_statement = (
+    delete(Task).where(Task.id == bindparam("task_id"), in_list).returning(Task)
+)
+# executemany'd by TaskAPI.flush(), one parameter set per pending deferral
+flush_deferrals_statement = (
+    update(Task.__table__)
+    .where(Task.__table__.c.id == bindparam("task_id"))
+    .values(last_deferred=bindparam("deferred_at"))
+)
+
+# defaults of the write-behind deferrals flush: at most flush_interval
+# seconds after the first pending deferral, or once flush_count are pending
+flush_interval = 2.0
+flush_count = 50
+
+
+def completion_event(task: Task) -> TaskEventKind:
+    """Kind of the event published when a task's is_completed was set."""
+    return TaskEventKind.COMPLETED if task.is_completed else TaskEventKind.REOPENED
+
+
 class TaskAPI:
-    """API for the Single Task app"""
+    """API for the Single Task app
+
+    With cache_queue=True the incomplete tasks are also kept in an in-memory
+    queue (see TaskQueue) so get_next_task() doesn't hit the DB. Every write
+    still goes to the DB first, then is applied to the queue.
+
+    profile selects the SQLite performance profile (see db.profiles).
+    compact=True opts in to the compact storage format (see db.get_engine).
+    instrument=True records per method call counts, timings, SQL statements
+    and rows (see stats_snapshot() and instrumentation.Instrumentation).
 
-    def __init__(self, db_url):
+    Every change is published as a TaskEvent once committed,
+    see subscribe().
+
+    Calls reuse a session per thread (see sessions.SessionManager), several
+    calls can be grouped in one transaction with unit_of_work().
+
+    write_behind=True (which implies cache_queue=True) makes defer_task()
+    apply deferrals to the queue and publish their events right away, but
+    write them to the DB later, in one transaction per batch: flush_interval
+    seconds after the first pending one, once flush_count are pending, on
+    flush() and close(). Every other call touching the DB flushes first, so
+    it sees them. A crash (or a failed flush, which keeps them pending)
+    loses at most the deferrals not flushed yet, i.e. the tasks' order; no
+    other change is ever delayed and a batch is written entirely or not at
+    all. Deferrals made inside unit_of_work() aren't part of it.
+
+    A TaskAPI only sees the tasks of its list (list_id), see for_list() for
+    the other ones. With shards=True every other list is kept in a DB file
+    of its own (see db.shard_db_url()) instead of the same one.
+    """
+
+    def __init__(
+        self,
+        db_url,
+        cache_queue: bool = False,
+        profile: str | None = None,
+        compact: bool = False,
+        instrument: bool = False,
+        write_behind: bool = False,
+        flush_interval: float = flush_interval,
+        flush_count: int = flush_count,
+        list_id: str = default_list_id,
+        shards: bool = False,
+    ):
         self.db_url = db_url
-        self._engine = get_engine(db_url)
+        self._engine = get_engine(db_url, profile=profile, compact=compact)
+        self.instrumentation = None
+        if instrument:
+            self.instrumentation = Instrumentation()
+            self.instrumentation.attach(self._engine)
+        self._sessions = SessionManager(self._engine)
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count
+        # options of the TaskAPIs of the shards, see for_list()
+        self._options = dict(
+            cache_queue=cache_queue,
+            profile=profile,
+            compact=compact,
+            instrument=instrument,
+            write_behind=write_behind,
+            flush_interval=flush_interval,
+            flush_count=flush_count,
+        )
+        self.shard_dir = shard_dir(db_url) if shards else None
+        # list id -> its TaskAPI, shared by the TaskAPIs of every list
+        self._lists = {}
+        self._lists_lock = RLock()
+        self._init_list(list_id, cache_queue or write_behind)
+
+    def _init_list(self, list_id: str, cache_queue: bool) -> None:
+        """Set up the state of the TaskAPI of a list."""
+        self.list_id = check_list_id(list_id)
+        self.events = TaskEvents()
+        # task id -> last_deferred of the deferrals not written yet
+        self._deferrals = {}
+        self._deferrals_lock = RLock()
+        # set while deferrals are pending, see _flush_loop()
+        self._flush_due = Event()
+        self._flusher_stopped = Event()
+        self._flusher = None
+        self._queue = None
+        if cache_queue:
+            self._queue = TaskQueue()
+            self._queue.load(self.list_incomplet_by_last_deferred())
+        self._lists[self.list_id] = self
+
+    def for_list(self, list_id: str) -> "TaskAPI":
+        """The TaskAPI of the tasks of list list_id (a list exists once it
+        has a task), with the same options, always the same one for a list.
+        It has its own events and queue cache. It shares this API's DB
+        connections, or with shards=True has its own in the list's file.
+        """
+        list_id = check_list_id(list_id)
+        with self._lists_lock:
+            api = self._lists.get(list_id)
+            if api is not None:
+                return api
+            if self.shard_dir is None:
+                api = copy(self)
+                api._init_list(list_id, self._queue is not None)
+                return api
+            url = shard_db_url(self.shard_dir, list_id)
+            api = TaskAPI(url, list_id=list_id, **self._options)
+            api.shard_dir = self.shard_dir
+            api._lists = self._lists
+            api._lists_lock = self._lists_lock
+            self._lists[list_id] = api
+            return api
+
+    def _list_apis(self, same_file: bool = False) -> list["TaskAPI"]:
+        """The TaskAPIs of every list, or of the ones in this DB file."""
+        with self._lists_lock:
+            apis = list(self._lists.values())
+        if same_file:
+            apis = [api for api in apis if api._engine is self._engine]
+        return apis
+
+    @instrumented
+    def list_ids(self) -> list[str]:
+        """Ids of the lists having tasks (in this DB file or in the shards)
+        and of the ones opened with for_list().
+        """
+        with self._session() as session:
+            ids = set(session.exec(select(Task.list_id).distinct()).all())
+        with self._lists_lock:
+            ids.update(self._lists)
+        if self.shard_dir is not None:
+            ids.update(path.stem for path in self.shard_dir.glob("*.sqlite3"))
+        return sorted(ids)
+
+    def stats_snapshot(self) -> dict:
+        """Per method stats recorded so far, empty if instrumentation is off."""
+        if self.instrumentation is None:
+            return {}
+        return self.instrumentation.snapshot()
+
+    def unit_of_work(self):
+        """Context manager running the calls made in its block (in the same
+        thread) in a single transaction, committed at the end of the block
+        or rolled back if it raises. Events are published and the queue
+        cache updated once it's committed.
+        """
+        return self._sessions.unit_of_work()
+
+    def close(self) -> None:
+        """Flush the pending deferrals, close the reused sessions and the DB
+        connections, of every list (see for_list()).
+        """
+        apis = self._list_apis()
+        for api in apis:
+            api._stop_flusher()
+            api.flush()
+        engines = set()
+        for api in apis:
+            if api._engine not in engines:
+                engines.add(api._engine)
+                api._sessions.close()
+                api._engine.dispose()
+
+    def subscribe(self, callback: Callable[[TaskEvent], None]) -> Callable[[], None]:
+        """Call callback with a TaskEvent after every committed change
+        (one per affected task). Return a function unsubscribing it.
+        """
+        return self.events.subscribe(callback)
+
+    def _session(self, write: bool = False):
+        """The thread's session for a call (see SessionManager.session),
+        after writing the pending deferrals so the call sees them.
+        """
+        if self._deferrals:
+            self.flush()
+        return self._sessions.session(write)
+
+    @instrumented
+    def flush(self) -> int:
+        """Write the pending (write-behind) deferrals to the DB in a single
+        transaction and return how many were written. They stay pending if
+        it fails.
+        """
+        with self._deferrals_lock:
+            self._flush_due.clear()
+            if not self._deferrals:
+                return 0
+            pending, self._deferrals = self._deferrals, {}
+            rows = [
+                {"task_id": id, "deferred_at": deferred_at}
+                for id, deferred_at in pending.items()
+            ]
+            try:
+                with self._sessions.session(write=True) as session:
+                    session.execute(flush_deferrals_statement, rows)
+            except BaseException:
+                self._deferrals = pending
+                self._schedule_flush()
+                raise
+            # in a unit of work, the rows are only written if it commits
+            self._sessions.after_rollback(self._restore_deferrals, pending)
+            return len(rows)
+
+    def _restore_deferrals(self, pending: dict) -> None:
+        """Make the deferrals of a rolled back flush pending again."""
+        with self._deferrals_lock:
+            # the ones made since are newer
+            self._deferrals = {**pending, **self._deferrals}
+            self._schedule_flush()
+
+    def _flush_loop(self) -> None:
+        """Write-behind flusher thread: flush() flush_interval seconds after
+        a deferral is pending, again at the next interval if it fails.
+        A single long-lived thread, so a single reused session.
+        """
+        while True:
+            self._flush_due.wait()
+            if self._flusher_stopped.wait(self.flush_interval):
+                return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("flushing %d deferrals failed", len(self._deferrals))
 
+    def _schedule_flush(self) -> None:
+        """Have the flusher thread flush in flush_interval seconds."""
+        with self._deferrals_lock:
+            if self._flusher is None and not self._flusher_stopped.is_set():
+                self._flusher = Thread(
+                    target=self._flush_loop, name="task-flusher", daemon=True
+                )
+                self._flusher.start()
+            self._flush_due.set()
+
+    def _stop_flusher(self) -> None:
+        self._flusher_stopped.set()
+        self._flush_due.set()
+        if self._flusher is not None:
+            self._flusher.join()
+
+    def _defer_behind(self, id: UUID) -> bool:
+        """Defer a queued task in memory only and queue the DB write, see
+        write_behind. Return False if the task isn't queued (it's completed
+        or doesn't exist), it's then deferred in the DB right away.
+        """
+
+        def defer(queued: Task) -> Task:
+            task = Task(**queued.model_dump())
+            task.last_deferred = datetime.now()
+            return task
+
+        with self._deferrals_lock:
+            # not completed or deleted (by another thread) in between
+            task = self._queue.update(id, defer)
+            if task is None:
+                return False
+            self._deferrals[id] = task.last_deferred
+            if len(self._deferrals) >= self.flush_count:
+                self.flush()
+            else:
+                self._schedule_flush()
+        self.events.publish(TaskEventKind.DEFERRED, id, Task(**task.model_dump()))
+        return True
+
+    def _validate_id(self, id: UUID | str) -> UUID:
+        """Check and convert a task id (UUID or str) to a UUID."""
+        if isinstance(id, UUID):
+            return id
+        if not isinstance(id, str):
+            raise InvalidTaskID("Task id must be a UUID or a string.")
+        try:
+            return UUID(id)
+        except ValueError:
+            raise InvalidTaskID(f"[Error] invalid task id: {id}")
+
+    def _validate_ids(self, ids: list[UUID | str]) -> list[UUID]:
+        """Check and convert a list of task ids (UUID or str) to UUIDs."""
+        return [self._validate_id(id) for id in ids]
+
+    def _publish(self, kind: TaskEventKind, task_id, task=None) -> None:
+        """Publish a change event, once the change is committed."""
+        self._sessions.after_commit(self.events.publish, kind, task_id, task)
+
+    def _cache_task(self, task: Task) -> None:
+        """Apply a task's new state to the in-memory queue (if enabled),
+        once it's committed.
+        """
+        if self._queue is None:
+            return
+        if task.is_completed:
+            self._sessions.after_commit(self._queue.remove, task.id)
+        else:
+            self._sessions.after_commit(self._queue.push, Task(**task.model_dump()))
+
+    def _uncache_task(self, id: UUID) -> None:
+        """Remove a task from the in-memory queue (if enabled), once committed."""
+        if self._queue is not None:
+            self._sessions.after_commit(self._queue.remove, id)
+
+    def _recache_task(self, task: Task) -> None:
+        """Update a task already in the in-memory queue, once committed."""
+        if self._queue is not None:
+            self._sessions.after_commit(self._update_queued_task, task)
+
+    def _update_queued_task(self, task: Task) -> None:
+        self._queue.update(task.id, lambda queued: Task(**task.model_dump()))
+
+    @instrumented
     def add_task(self, task: Task) -> UUID:
         """Add a task and return the id of the task."""
         if not task.title:
@@ -41,147 +507,656 @@ class TaskAPI:
 
         if not isinstance(task.title, str):
             raise InvalidTitle("task title must be a string.")
-        with Session(self._engine) as session:
-            task_id = task.id
+        if task.is_completed and task.completed_at is None:
+            task.completed_at = datetime.now()
+        task.list_id = self.list_id
+        task_id = task.id
+        added_task = Task(**task.model_dump())
+        with self._session(write=True) as session:
             session.add(task)
-            session.commit()
-            return task_id
+        self._cache_task(added_task)
+        self._publish(TaskEventKind.ADDED, task_id, added_task)
+        return task_id
+
+    @instrumented
+    def add_tasks(self, tasks: list[Task]) -> list[UUID]:
+        """Add many tasks in a single transaction and return their ids."""
+        for task in tasks:
+            if not task.title:
+                raise MissingTitle("a task must have a title.")
+            if not isinstance(task.title, str):
+                raise InvalidTitle("task title must be a string.")
+        rows = [task.model_dump() for task in tasks]
+        if not rows:
+            return []
+        now = datetime.now()
+        for row in rows:
+            if row["is_completed"] and row["completed_at"] is None:
+                row["completed_at"] = now
+            row["list_id"] = self.list_id
+        with self._session(write=True) as session:
+            session.exec(insert(Task), params=rows)
+        for row in rows:
+            task = Task(**row)
+            self._cache_task(task)
+            self._publish(TaskEventKind.ADDED, task.id, task)
+        return [row["id"] for row in rows]
 
+    @instrumented
     def list_all_tasks(self) -> list[Task]:
         """List all tasks in DB."""
-        with Session(self._engine) as session:
-            statement = select(Task)
+        with self._session() as session:
+            statement = select(Task).where(Task.list_id == self.list_id)
             results = session.exec(statement)
             tasks = results.all()
             return tasks
 
+    def _filter_status(self, statement, status: str):
+        """Filter statement by the API's list and status, one of task_statuses.
+        Table columns are used, which keeps a Core statement free of ORM.
+        """
+        if status not in task_statuses:
+            raise InvalidStatus(f"[Error] status must be one of: {task_statuses}")
+        columns = Task.__table__.c
+        statement = statement.where(columns.list_id == self.list_id)
+        if status != "all":
+            completed = status == "completed"
+            statement = statement.where(columns.is_completed == completed)
+        return statement
+
+    def _list_statement(self, statement, after=None, limit=None, status="all"):
+        """Filter statement by status, then order it by creation (oldest first)
+        starting after the given task (keyset pagination) up to limit rows.
+        """
+        statement = self._filter_status(statement, status)
+        columns = Task.__table__.c
+        if after is not None:
+            cursor = tuple_(
+                after.created_at,
+                after.id,
+                types=[columns.created_at.type, columns.id.type],
+            )
+            statement = statement.where(tuple_(columns.created_at, columns.id) > cursor)
+        return statement.order_by(columns.created_at, columns.id).limit(limit)
+
+    @instrumented
+    def list_tasks(
+        self, after: Task | None = None, limit: int = 50, status: str = "all"
+    ) -> list[Task]:
+        """List a page of tasks ordered by creation (oldest first).
+        after is the last task of the previous page (keyset pagination),
+        status is one of "all", "active" or "completed".
+        """
+        statement = self._list_statement(select(Task), after, limit, status)
+        with self._session() as session:
+            results = session.exec(statement)
+            tasks = results.all()
+            return tasks
+
+    @instrumented
+    def list_task_rows(
+        self,
+        after: Task | TaskRow | None = None,
+        limit: int | None = None,
+        status: str = "all",
+    ) -> list[TaskRow]:
+        """Like list_tasks() but return lightweight TaskRow objects
+        (no ORM objects, identity map or validation), all of them if no limit.
+        """
+        statement = self._list_statement(select(*task_row_columns), after, limit, status)
+        with self._session() as session:
+            return [TaskRow(*row) for row in session.execute(statement)]
+
+    def iter_task_rows(
+        self, status: str = "all", batch_size: int = 1000
+    ) -> Iterator[TaskRow]:
+        """Stream every task as a TaskRow, fetching batch_size rows at a time
+        instead of building the whole list in memory.
+        """
+        statement = self._list_statement(select(*task_row_columns), status=status)
+        if self._deferrals:
+            self.flush()
+        with self._engine.connect() as conn:
+            results = conn.execution_options(yield_per=batch_size).execute(statement)
+            for row in results:
+                yield TaskRow(*row)
+
+    def _check_format(self, format: str) -> None:
+        if format not in transfer_formats:
+            raise InvalidFormat(f"[Error] format must be one of: {transfer_formats}")
+
+    @instrumented
+    def export_tasks(
+        self,
+        stream: TextIO,
+        format: str = "jsonl",
+        status: str = "all",
+        batch_size: int = 1000,
+    ) -> TransferStats:
+        """Write every task (of status) to the text stream, see transfer.py
+        for the formats, fetching batch_size rows at a time. Open a csv
+        stream with newline="".
+        """
+        self._check_format(format)
+        columns = [Task.__table__.c[name] for name in transfer_columns]
+        statement = self._list_statement(select(*columns), status=status)
+        if self._deferrals:
+            self.flush()
+        started = time.perf_counter()
+        with self._engine.connect() as conn:
+            results = conn.execution_options(yield_per=batch_size).execute(statement)
+            rows = write_records(stream, format, results)
+        return TransferStats(rows, time.perf_counter() - started)
+
+    @instrumented
+    def import_tasks(
+        self, stream: TextIO, format: str = "jsonl", chunk_size: int = 10_000
+    ) -> TransferStats:
+        """Add the tasks read from the text stream (as written by
+        export_tasks()) keeping their ids and timestamps. They're inserted
+        chunk_size at a time, one transaction per chunk: when a row is
+        invalid (InvalidImport) the chunks before it stay imported.
+        A single IMPORTED event is published at the end.
+        """
+        self._check_format(format)
+        started = time.perf_counter()
+        imported = 0
+        try:
+            for chunk in ichunked(self._import_rows(stream, format), chunk_size):
+                rows = [row for _, row in chunk]
+                self._import_chunk(rows, chunk[0][0], chunk[-1][0])
+                imported += len(rows)
+        finally:
+            if imported:
+                self._publish(TaskEventKind.IMPORTED, None)
+        return TransferStats(imported, time.perf_counter() - started)
+
+    def _import_rows(self, stream: TextIO, format: str):
+        """Yield the (line number, task row) of every task read from stream."""
+        now = datetime.now()
+        try:
+            for line_number, record in read_records(stream, format):
+                try:
+                    row = import_row(record, now)
+                except ValueError as e:
+                    raise InvalidImport(f"[Error] line {line_number}: {e}")
+                row["list_id"] = self.list_id
+                yield line_number, row
+        except ValueError as e:
+            # read_records() errors already tell the line
+            raise InvalidImport(f"[Error] {e}")
+
+    def _import_chunk(self, rows: list[dict], first_line, last_line) -> None:
+        try:
+            with self._session(write=True) as session:
+                session.execute(insert(Task.__table__), rows)
+        except IntegrityError:
+            raise InvalidImport(
+                f"[Error] lines {first_line}-{last_line}: a task id already exists"
+            )
+        if self._queue is not None:
+            for row in rows:
+                if not row["is_completed"]:
+                    self._cache_task(Task(**row))
+
+    @instrumented
+    def search_tasks(
+        self, query: str, limit: int = 50, status: str = "all"
+    ) -> list[TaskRow]:
+        """Find tasks by title through the task_fts full-text index.
+        Every word of query must match the start of a word of the title
+        (case insensitive), best matches first. Return TaskRows.
+        """
+        match = search_query(query)
+        statement = self._filter_status(select(*task_row_columns), status)
+        if not match:
+            return []
+        statement = (
+            statement.join(task_fts, task_fts.c.rowid == literal_column("task.rowid"))
+            .where(literal_column("task_fts").op("MATCH")(match))
+            .order_by(task_fts.c.rank)
+            .limit(limit)
+        )
+        with self._session() as session:
+            return [TaskRow(*row) for row in session.execute(statement)]
+
+    @instrumented
     def list_incomplet_by_last_deferred(self) -> list[Task]:
         """List only incomplete tasks orderd by last_deferred first."""
-        with Session(self._engine) as session:
+        with self._session() as session:
             statement = (
                 select(Task)
-                .where(Task.is_completed == False)
+                .where(Task.list_id == self.list_id, Task.is_completed == False)
                 .order_by(Task.last_deferred.asc())
             )
             results = session.exec(statement)
             tasks = results.all()
             return tasks
 
+    @instrumented
     def list_completed_tasks(self) -> list[Task]:
         """List only completed tasks."""
-        with Session(self._engine) as session:
-            statement = select(Task).where(Task.is_completed == True)
+        with self._session() as session:
+            statement = select(Task).where(
+                Task.list_id == self.list_id, Task.is_completed == True
+            )
             results = session.exec(statement)
             tasks = results.all()
             return tasks
 
+    @instrumented
     def list_incomplete_tasks(self) -> list[Task]:
         """List only incompleted tasks."""
-        with Session(self._engine) as session:
-            statement = select(Task).where(Task.is_completed == False)
+        with self._session() as session:
+            statement = select(Task).where(
+                Task.list_id == self.list_id, Task.is_completed == False
+            )
             results = session.exec(statement)
             tasks = results.all()
             return tasks
 
+    @instrumented
     def get_task(self, id: UUID) -> Task:
         """Retrieve a single task by id."""
-        if not isinstance(id, str):
-            raise InvalidTaskID("Task id must be a string.")
-        with Session(self._engine) as session:
-            statement = select(Task).where(Task.id == UUID(id))
+        task_id = self._validate_id(id)
+        with self._session() as session:
             try:
-                task = session.exec(statement).one()
+                params = {"task_id": task_id, "task_list": self.list_id}
+                task = session.exec(task_by_id, params=params).one()
                 return task
             except NoResultFound as e:
                 raise TaskNotFound(f"[Error] No results found for the given id: {e}")
 
+    def _update_task(self, id: UUID, action: str, statement, **params) -> Task:
+        """Update a single task with one of the `UPDATE ... RETURNING`
+        statements above and return the updated task.
+        """
+        task_id = self._validate_id(id)
+        with self._session(write=True) as session:
+            params.update(task_id=task_id, task_list=self.list_id)
+            task = session.exec(statement, params=params).scalars().one_or_none()
+            if task is None:
+                raise TaskNotFound(
+                    f"[Error] can't {action} task. No results found for the given id"
+                )
+            return task
+
+    @instrumented
     def update_task_title(self, id: UUID, title: str) -> Task:
         """Update title for a task identified by its id"""
         if not title:
             raise MissingTitle("title can not be empty")
-        
-        task = self.get_task(id)
-        if task is not None:
-            with Session(self._engine) as session:
-                task.title = title
-                session.add(task)
-                session.commit()
-                session.refresh(task)
-                return task
-        else:
-            raise TaskNotFound(
-                "[Error] can't defer task. No results found for the given id"
-            )
 
+        task = self._update_task(id, "update", update_title_statement, new_title=title)
+        self._recache_task(task)
+        self._publish(TaskEventKind.UPDATED, task.id, task)
+        return task
+
+    @instrumented
     def delete_task(self, id: UUID) -> None:
         """Delete a single task by id."""
-        task = self.get_task(id)
-        if task is not None:
-            with Session(self._engine) as session:
-                try:
-                    session.delete(task)
-                    session.commit()
-                except NoResultFound as e:
-                    raise TaskNotFound(
-                        f"[Error] No results found for the given id: {e}"
-                    )
-        else:
-            raise TaskNotFound(
-                "[Error] can't defer task. No results found for the given id"
-            )
+        task_id = self._validate_id(id)
+        with self._session(write=True) as session:
+            params = {"task_id": task_id, "task_list": self.list_id}
+            task = session.exec(delete_statement, params=params).scalars().one_or_none()
+            if task is None:
+                raise TaskNotFound(
+                    "[Error] can't delete task. No results found for the given id"
+                )
+        self._uncache_task(task_id)
+        self._publish(TaskEventKind.DELETED, task_id, task)
 
+    @instrumented
     def defer_task(self, id: UUID) -> None:
         """Defer a task by id."""
-        task = self.get_task(id)
-        if task is not None:
-            with Session(self._engine) as session:
-                task.last_deferred = datetime.now()
-                session.add(task)
-                session.commit()
-                session.refresh(task)
-        else:
-            raise TaskNotFound(
-                "[Error] can't defer task. No results found for the given id"
-            )
+        if self.write_behind and self._defer_behind(self._validate_id(id)):
+            return
+        task = self._update_task(id, "defer", defer_statement, now=datetime.now())
+        self._cache_task(task)
+        self._publish(TaskEventKind.DEFERRED, task.id, task)
 
+    @instrumented
     def get_next_task(self) -> Task:
         """Retrieve next task in the queue."""
-        with Session(self._engine) as session:
-            statement = (
-                select(Task)
-                .where(Task.is_completed == False)
-                .order_by(Task.last_deferred.asc())
-            )
-            results = session.exec(statement)
-            next_task = results.first()
-            return next_task
+        if self._queue is not None:
+            return self._queue.peek()
+        with self._session() as session:
+            params = {"task_list": self.list_id}
+            return session.exec(next_task_statement, params=params).first()
 
+    @instrumented
     def toggle_complete(self, id: UUID) -> Task:
         """Toggle a task's is_completed"""
-        task = self.get_task(id)
-        if task is not None:
-            with Session(self._engine) as session:
-                task.is_completed = not task.is_completed
-                session.add(task)
-                session.commit()
-                session.refresh(task)
-                return task
-        else:
-            raise TaskNotFound(
-                "[Error] can't complete task. No results found for the given id"
+        task = self._update_task(
+            id, "complete", toggle_complete_statement, now=datetime.now()
+        )
+        self._cache_task(task)
+        self._publish(completion_event(task), task.id, task)
+        return task
+
+    @instrumented
+    def defer_tasks(self, ids: list[UUID | str]) -> int:
+        """Defer many tasks by id in a single transaction.
+        Return the number of tasks deferred.
+        """
+        uuids = self._validate_ids(ids)
+        now = datetime.now()
+        deferred = []
+        with self._session(write=True) as session:
+            for chunk in chunked(uuids):
+                statement = (
+                    update(Task)
+                    .where(col(Task.id).in_(chunk), Task.list_id == self.list_id)
+                    .values(last_deferred=now)
+                    .returning(Task)
+                )
+                deferred.extend(session.exec(statement).scalars())
+        for task in deferred:
+            self._cache_task(task)
+            self._publish(TaskEventKind.DEFERRED, task.id, task)
+        return len(deferred)
+
+    @instrumented
+    def set_completed_many(
+        self, ids: list[UUID | str], completed: bool = True
+    ) -> int:
+        """Set is_completed on many tasks by id in a single transaction.
+        Return the number of tasks updated (the ones already in that state
+        are left as is).
+        """
+        uuids = self._validate_ids(ids)
+        completed_at = datetime.now() if completed else None
+        updated = []
+        with self._session(write=True) as session:
+            for chunk in chunked(uuids):
+                statement = (
+                    update(Task)
+                    .where(
+                        col(Task.id).in_(chunk),
+                        Task.list_id == self.list_id,
+                        Task.is_completed != completed,
+                    )
+                    .values(is_completed=completed, completed_at=completed_at)
+                    .returning(Task)
+                )
+                updated.extend(session.exec(statement).scalars())
+        for task in updated:
+            self._cache_task(task)
+            self._publish(completion_event(task), task.id, task)
+        return len(updated)
+
+    @instrumented
+    def delete_tasks(self, ids: list[UUID | str]) -> int:
+        """Delete many tasks by id in a single transaction.
+        Return the number of tasks deleted.
+        """
+        uuids = self._validate_ids(ids)
+        deleted = []
+        with self._session(write=True) as session:
+            for chunk in chunked(uuids):
+                statement = (
+                    delete(Task)
+                    .where(col(Task.id).in_(chunk), Task.list_id == self.list_id)
+                    .returning(Task)
+                )
+                deleted.extend(session.exec(statement).scalars())
+        for task in deleted:
+            self._uncache_task(task.id)
+            self._publish(TaskEventKind.DELETED, task.id, task)
+        return len(deleted)
+
+    @instrumented
+    def clear_completed(self) -> int:
+        """Delete all completed tasks and return how many were deleted."""
+        with self._session(write=True) as session:
+            statement = (
+                delete(Task)
+                .where(Task.list_id == self.list_id, Task.is_completed == True)
+                .returning(Task)
+            )
+            deleted = session.exec(statement).scalars().all()
+        for task in deleted:
+            self._publish(TaskEventKind.DELETED, task.id, task)
+        return len(deleted)
+
+    @instrumented
+    def archive_completed(
+        self, older_than: timedelta | datetime, batch_size: int = ID_CHUNK_SIZE
+    ) -> int:
+        """Move the tasks completed before older_than (a date, or an age)
+        from the task table to the archive table, batch_size tasks per
+        transaction. Return the number of tasks archived.
+        """
+        if isinstance(older_than, timedelta):
+            older_than = datetime.now() - older_than
+        task_columns = [Task.__table__.c[name] for name in archived_columns]
+        archived = 0
+        while True:
+            with self._session(write=True) as session:
+                statement = (
+                    select(Task.id)
+                    .where(
+                        Task.list_id == self.list_id,
+                        Task.is_completed == True,
+                        Task.completed_at < older_than,
+                    )
+                    .limit(batch_size)
+                )
+                ids = session.exec(statement).all()
+                if not ids:
+                    break
+                session.exec(
+                    insert(ArchivedTask).from_select(
+                        archived_columns,
+                        select(*task_columns).where(col(Task.id).in_(ids)),
+                    )
+                )
+                statement = delete(Task).where(col(Task.id).in_(ids)).returning(Task)
+                tasks = session.exec(statement).scalars().all()
+            archived += len(tasks)
+            for task in tasks:
+                self._publish(TaskEventKind.ARCHIVED, task.id, task)
+        return archived
+
+    @instrumented
+    def list_archived_tasks(
+        self, after: ArchivedTask | None = None, limit: int = 50
+    ) -> list[ArchivedTask]:
+        """List a page of archived tasks, last completed first.
+        after is the last task of the previous page (keyset pagination).
+        """
+        statement = select(ArchivedTask).where(ArchivedTask.list_id == self.list_id)
+        if after is not None:
+            cursor = tuple_(
+                after.completed_at,
+                after.id,
+                types=[ArchivedTask.completed_at.type, ArchivedTask.id.type],
             )
+            statement = statement.where(
+                tuple_(ArchivedTask.completed_at, ArchivedTask.id) < cursor
+            )
+        statement = statement.order_by(
+            col(ArchivedTask.completed_at).desc(), col(ArchivedTask.id).desc()
+        ).limit(limit)
+        with self._session() as session:
+            return session.exec(statement).all()
 
+    @instrumented
+    def count_archived_tasks(self) -> int:
+        """Return the count of archived tasks."""
+        with self._session() as session:
+            statement = (
+                select(func.count())
+                .select_from(ArchivedTask)
+                .where(ArchivedTask.list_id == self.list_id)
+            )
+            return session.exec(statement).one()
+
+    @instrumented
+    def restore_task(self, id: UUID | str) -> Task:
+        """Move an archived task back to the task table (still completed)
+        and return it.
+        """
+        task_id = self._validate_id(id)
+        with self._session(write=True) as session:
+            statement = (
+                delete(ArchivedTask)
+                .where(ArchivedTask.id == task_id, ArchivedTask.list_id == self.list_id)
+                .returning(ArchivedTask)
+            )
+            archived_task = session.exec(statement).scalars().one_or_none()
+            if archived_task is None:
+                raise TaskNotFound(
+                    "[Error] can't restore task. No archived task for the given id"
+                )
+            task = Task(**archived_task.model_dump())
+            session.add(task)
+        self._publish(TaskEventKind.RESTORED, task.id, task)
+        return task
+
+    @instrumented
     def count_tasks(self) -> int:
         """Return the count of all tasks in the DB."""
-        with Session(self._engine) as session:
-            statement = select(func.count()).select_from(Task)
-            results = session.exec(statement)
-            task_count = results.one()
-            return task_count
+        with self._session() as session:
+            params = {"task_list": self.list_id}
+            return session.exec(count_statement, params=params).one()
 
+    @instrumented
+    def task_stats(self) -> TaskStats:
+        """Return the total, active and completed task counts in one query."""
+        with self._session() as session:
+            statement = (
+                select(Task.is_completed, func.count())
+                .where(Task.list_id == self.list_id)
+                .group_by(Task.is_completed)
+            )
+            counts = dict(session.exec(statement).all())
+            active = counts.get(False, 0)
+            completed = counts.get(True, 0)
+            return TaskStats(active + completed, active, completed)
+
+    @instrumented
     def delete_all_tasks(self) -> None:
         """Delete all tasks from the DB."""
-        with Session(self._engine) as session:
-            statement = delete(Task)
+        with self._session(write=True) as session:
+            statement = delete(Task).where(Task.list_id == self.list_id)
             session.exec(statement)
-            session.commit()
+        if self._queue is not None:
+            self._sessions.after_commit(self._queue.clear)
+        self._publish(TaskEventKind.ALL_DELETED, None)
+
+    @instrumented
+    def backup(
+        self, path: Path | str, pages: int = pages_per_step, sleep: float = step_sleep
+    ) -> Path:
+        """Copy the DB file (every list in it, not the shards) to path while
+        it stays in use, see backups.backup_to_file(). Pending deferrals
+        are written first.
+        """
+        for api in self._list_apis(same_file=True):
+            api.flush()
+        with self._engine.connect() as conn:
+            return backup_to_file(conn.connection.driver_connection, path, pages, sleep)
+
+    @instrumented
+    def restore(
+        self, path: Path | str, pages: int = pages_per_step, sleep: float = step_sleep
+    ) -> None:
+        """Replace the content of the DB file (every list in it, not the
+        shards) with the backup at path, upgraded to the current schema if
+        it's older. The backup is checked for integrity first (CorruptBackup).
+        The calls of the other threads wait while the DB is replaced.
+        Pending deferrals are dropped, the queue caches reloaded and a
+        REPLACED event published to every list of the file.
+        """
+        staging = db_file(self.db_url).with_suffix(".restore")
+        source = open_backup(path)
+        try:
+            staging.unlink(missing_ok=True)
+            target = sqlite3.connect(staging)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+        try:
+            # migrated by get_engine() like any DB file opened by the app
+            compact = self._engine.dialect.compact_storage
+            staging_engine = get_engine(f"sqlite:///{staging}", compact=compact)
+            try:
+                if staging_engine.dialect.compact_storage != compact:
+                    raise BackupException(
+                        "[Error] a compact backup can only be restored to a DB "
+                        "opened with compact=True"
+                    )
+                apis = self._list_apis(same_file=True)
+                for api in apis:
+                    api._drop_deferrals()
+                # no call (of any thread) uses the DB while it's replaced,
+                # and none reuses a connection that saw it before
+                with self._sessions.exclusive():
+                    target = sqlite3.connect(db_file(self.db_url))
+                    try:
+                        with staging_engine.connect() as staging_conn:
+                            staging_conn.connection.driver_connection.backup(
+                                target, pages=pages, sleep=sleep
+                            )
+                    finally:
+                        target.close()
+                    self._engine.dispose()
+            finally:
+                staging_engine.dispose()
+        finally:
+            for suffix in ("", "-wal", "-shm"):
+                staging.with_name(staging.name + suffix).unlink(missing_ok=True)
+        for api in apis:
+            if api._queue is not None:
+                api._queue.load(api.list_incomplet_by_last_deferred())
+            api.events.publish(TaskEventKind.REPLACED, None)
+
+    def _drop_deferrals(self) -> None:
+        with self._deferrals_lock:
+            self._flush_due.clear()
+            self._deferrals = {}
+
+    def snapshot(
+        self, directory: Path | str | None = None, keep: int = snapshots_kept
+    ) -> Path:
+        """Back the DB up to a new timestamped file in directory (see
+        db.backup_dir() by default), keeping only the keep newest ones.
+        Return the new snapshot's path.
+        """
+        directory = Path(directory or backup_dir(self.db_url))
+        path = self.backup(snapshot_path(directory))
+        rotate_snapshots(directory, keep)
+        return path
+
+    def start_snapshots(
+        self,
+        interval: float,
+        directory: Path | str | None = None,
+        keep: int = snapshots_kept,
+    ):
+        """Take a snapshot() every interval seconds from a background
+        thread, the first one as soon as the newest snapshot is interval
+        seconds old. Return a function that stops it.
+        """
+        directory = Path(directory or backup_dir(self.db_url))
+        stopped = Event()
+
+        def run():
+            snapshots = list_snapshots(directory)
+            wait = 0
+            if snapshots:
+                age = time.time() - snapshots[-1].stat().st_mtime
+                wait = max(interval - age, 0)
+            while not stopped.wait(wait):
+                try:
+                    self.snapshot(directory, keep)
+                except Exception:
+                    logger.exception("snapshot of %s failed", self.db_url)
+                wait = interval
+
+        Thread(target=run, name="task-api-snapshots", daemon=True).start()
+        return stopped.set
@@ -0,0 +1,207 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from functools import partial
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, TextIO
+from uuid import UUID
+
+from api import ID_CHUNK_SIZE, TaskAPI, TaskStats
+from events import TaskEvent
+from models import ArchivedTask, Task, TaskRow, default_list_id
+from transfer import TransferStats
+
+
+class AsyncTaskAPI:
+    """Async version of TaskAPI, for use in Flet async event handlers.
+
+    Every call runs the matching TaskAPI method on a single dedicated worker
+    thread, so the event loop never waits on SQLite I/O and DB writes are
+    still applied one at a time, in the order they were awaited.
+    The wrapped TaskAPI is available as `sync` for code that can't await
+    (e.g. Flet's build()).
+    """
+
+    def __init__(
+        self,
+        db_url,
+        cache_queue: bool = False,
+        profile: str | None = None,
+        compact: bool = False,
+        instrument: bool = False,
+        list_id: str = default_list_id,
+        shards: bool = False,
+        write_behind: bool = False,
+    ):
+        self.db_url = db_url
+        self.sync = TaskAPI(
+            db_url,
+            cache_queue=cache_queue,
+            profile=profile,
+            compact=compact,
+            instrument=instrument,
+            list_id=list_id,
+            shards=shards,
+            write_behind=write_behind,
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="task-api"
+        )
+        # loop of the awaiting callers, where subscribers are called
+        self._loop = None
+
+    async def _run(self, method, *args, **kwargs):
+        loop = self._loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(method, *args, **kwargs)
+        )
+
+    def close(self) -> None:
+        """Wait for pending calls, stop the worker thread and close the API."""
+        self._executor.shutdown(wait=True)
+        self.sync.close()
+
+    def for_list(self, list_id: str) -> "AsyncTaskAPI":
+        """AsyncTaskAPI of another list (see TaskAPI.for_list()), sharing
+        this one's worker thread.
+        """
+        api = copy(self)
+        api.sync = self.sync.for_list(list_id)
+        return api
+
+    def subscribe(self, callback: Callable[[TaskEvent], None]) -> Callable[[], None]:
+        """Like TaskAPI.subscribe(), but callback is called in the event loop
+        of the awaiting callers, so it can safely patch UI controls. Events of
+        an awaited call are delivered before the call returns.
+        """
+
+        def deliver(event):
+            loop = self._loop
+            if loop is None or loop.is_closed():
+                callback(event)
+            else:
+                loop.call_soon_threadsafe(callback, event)
+
+        return self.sync.subscribe(deliver)
+
+    async def add_task(self, task: Task) -> UUID:
+        return await self._run(self.sync.add_task, task)
+
+    async def add_tasks(self, tasks: list[Task]) -> list[UUID]:
+        return await self._run(self.sync.add_tasks, tasks)
+
+    async def list_all_tasks(self) -> list[Task]:
+        return await self._run(self.sync.list_all_tasks)
+
+    async def list_tasks(
+        self, after: Task | None = None, limit: int = 50, status: str = "all"
+    ) -> list[Task]:
+        return await self._run(self.sync.list_tasks, after, limit, status)
+
+    async def list_task_rows(
+        self,
+        after: Task | TaskRow | None = None,
+        limit: int | None = None,
+        status: str = "all",
+    ) -> list[TaskRow]:
+        return await self._run(self.sync.list_task_rows, after, limit, status)
+
+    async def search_tasks(
+        self, query: str, limit: int = 50, status: str = "all"
+    ) -> list[TaskRow]:
+        return await self._run(self.sync.search_tasks, query, limit, status)
+
+    async def export_tasks(
+        self,
+        stream: TextIO,
+        format: str = "jsonl",
+        status: str = "all",
+        batch_size: int = 1000,
+    ) -> TransferStats:
+        return await self._run(
+            self.sync.export_tasks, stream, format, status, batch_size
+        )
+
+    async def import_tasks(
+        self, stream: TextIO, format: str = "jsonl", chunk_size: int = 10_000
+    ) -> TransferStats:
+        return await self._run(self.sync.import_tasks, stream, format, chunk_size)
+
+    async def backup(self, path: Path | str) -> Path:
+        return await self._run(self.sync.backup, path)
+
+    async def restore(self, path: Path | str) -> None:
+        return await self._run(self.sync.restore, path)
+
+    async def snapshot(self, directory: Path | str | None = None) -> Path:
+        return await self._run(self.sync.snapshot, directory)
+
+    async def list_incomplet_by_last_deferred(self) -> list[Task]:
+        return await self._run(self.sync.list_incomplet_by_last_deferred)
+
+    async def list_completed_tasks(self) -> list[Task]:
+        return await self._run(self.sync.list_completed_tasks)
+
+    async def list_incomplete_tasks(self) -> list[Task]:
+        return await self._run(self.sync.list_incomplete_tasks)
+
+    async def get_task(self, id: UUID) -> Task:
+        return await self._run(self.sync.get_task, id)
+
+    async def update_task_title(self, id: UUID, title: str) -> Task:
+        return await self._run(self.sync.update_task_title, id, title)
+
+    async def delete_task(self, id: UUID) -> None:
+        return await self._run(self.sync.delete_task, id)
+
+    async def defer_task(self, id: UUID) -> None:
+        return await self._run(self.sync.defer_task, id)
+
+    async def flush(self) -> int:
+        return await self._run(self.sync.flush)
+
+    async def get_next_task(self) -> Task:
+        return await self._run(self.sync.get_next_task)
+
+    async def toggle_complete(self, id: UUID) -> Task:
+        return await self._run(self.sync.toggle_complete, id)
+
+    async def defer_tasks(self, ids: list[UUID | str]) -> int:
+        return await self._run(self.sync.defer_tasks, ids)
+
+    async def set_completed_many(
+        self, ids: list[UUID | str], completed: bool = True
+    ) -> int:
+        return await self._run(self.sync.set_completed_many, ids, completed)
+
+    async def delete_tasks(self, ids: list[UUID | str]) -> int:
+        return await self._run(self.sync.delete_tasks, ids)
+
+    async def clear_completed(self) -> int:
+        return await self._run(self.sync.clear_completed)
+
+    async def archive_completed(
+        self, older_than: timedelta | datetime, batch_size: int = ID_CHUNK_SIZE
+    ) -> int:
+        return await self._run(self.sync.archive_completed, older_than, batch_size)
+
+    async def list_archived_tasks(
+        self, after: ArchivedTask | None = None, limit: int = 50
+    ) -> list[ArchivedTask]:
+        return await self._run(self.sync.list_archived_tasks, after, limit)
+
+    async def count_archived_tasks(self) -> int:
+        return await self._run(self.sync.count_archived_tasks)
+
+    async def restore_task(self, id: UUID | str) -> Task:
+        return await self._run(self.sync.restore_task, id)
+
+    async def count_tasks(self) -> int:
+        return await self._run(self.sync.count_tasks)
+
+    async def task_stats(self) -> TaskStats:
+        return await self._run(self.sync.task_stats)
+
+    async def delete_all_tasks(self) -> None:
+        return await self._run(self.sync.delete_all_tasks)
@@ -0,0 +1,100 @@
+"""Online backups of a task DB with SQLite's backup API, used by
+TaskAPI.backup(), TaskAPI.restore() and TaskAPI.snapshot().
+
+The backup API copies a consistent state of the DB while it stays in use:
+pages_per_step pages are copied at a time, other connections can read and
+write in between (a write by another connection restarts the copy).
+"""
+
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+# pages (of 4 KiB by default) copied per backup step, and the pause between
+# two steps (seconds) letting the other connections use the DB
+pages_per_step = 256
+step_sleep = 0.005
+# rotating snapshots kept by TaskAPI.snapshot()
+snapshots_kept = 7
+snapshot_prefix = "tasks-"
+snapshot_suffix = ".sqlite3"
+
+
+class BackupException(Exception):
+    pass
+
+
+class CorruptBackup(BackupException):
+    pass
+
+
+def check_integrity(conn: sqlite3.Connection, name: str) -> None:
+    """Raise CorruptBackup unless PRAGMA integrity_check passes."""
+    problems = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+    if problems != ["ok"]:
+        raise CorruptBackup(f"[Error] {name} failed its integrity check: {problems}")
+
+
+def backup_to_file(
+    source: sqlite3.Connection,
+    path: Path,
+    pages: int = pages_per_step,
+    sleep: float = step_sleep,
+) -> Path:
+    """Copy the source DB to the file at path, a standalone DB (rollback
+    journal instead of WAL) checked for integrity. It's written to a
+    temporary file first, path is only replaced by a complete backup.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.with_name(path.name + ".partial")
+    partial_path.unlink(missing_ok=True)
+    target = sqlite3.connect(partial_path)
+    try:
+        source.backup(target, pages=pages, sleep=sleep)
+        target.execute("PRAGMA journal_mode = DELETE")
+        check_integrity(target, "backup")
+    except BaseException:
+        target.close()
+        partial_path.unlink(missing_ok=True)
+        raise
+    target.close()
+    partial_path.replace(path)
+    return path
+
+
+def open_backup(path: Path) -> sqlite3.Connection:
+    """Read-only connection to a backup file, checked for integrity."""
+    path = Path(path)
+    if not path.is_file():
+        raise BackupException(f"[Error] no backup file at {path}")
+    conn = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        check_integrity(conn, str(path))
+    except sqlite3.DatabaseError as e:
+        conn.close()
+        raise CorruptBackup(f"[Error] {path} isn't a readable DB: {e}")
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+def snapshot_path(directory: Path, now: datetime | None = None) -> Path:
+    now = now or datetime.now()
+    stamp = now.strftime("%Y%m%d-%H%M%S-%f")
+    return Path(directory) / f"{snapshot_prefix}{stamp}{snapshot_suffix}"
+
+
+def list_snapshots(directory: Path) -> list[Path]:
+    """Snapshot files in directory, oldest first."""
+    return sorted(Path(directory).glob(f"{snapshot_prefix}*{snapshot_suffix}"))
+
+
+def rotate_snapshots(directory: Path, keep: int = snapshots_kept) -> list[Path]:
+    """Delete all but the keep newest snapshots, return the deleted ones."""
+    snapshots = list_snapshots(directory)
+    deleted = snapshots[: max(len(snapshots) - keep, 0)]
+    for path in deleted:
+        path.unlink(missing_ok=True)
+    return deleted
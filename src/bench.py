@@ -0,0 +1,374 @@
+"""Benchmarks for TaskAPI operations across dataset sizes.
+
+Populates a fresh DB per size, times each operation and prints a summary.
+Results can be written as JSON and compared between two runs (e.g. before
+and after a change) to spot regressions:
+
+    python bench.py --sizes 1000 100000 --output new.json
+    python bench.py --compare old.json new.json
+
+--overhead times the per call overhead of TaskAPI's session handling
+against a new Session per call (how TaskAPI used to run every call).
+
+--http URL load tests a running server (see server.py) with --clients
+concurrent clients making --ops requests each (needs httpx):
+
+    python bench.py --http http://127.0.0.1:8000 --clients 20
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from uuid import UUID
+
+import sqlalchemy
+from sqlmodel import Session, select, update
+
+from api import TaskAPI
+from models import Task
+
+default_sizes = (1_000, 100_000, 1_000_000)
+# operations timed `ops` times each, the ones reading the whole table
+# are timed `heavy_ops` times, delete_all_tasks only once (it empties the DB)
+light_operations = ("add_task", "defer_task", "get_next_task", "toggle_complete")
+heavy_operations = ("list_all_tasks", "count_tasks")
+operations = light_operations + heavy_operations + ("delete_all_tasks",)
+populate_chunk_size = 10_000
+completed_ratio = 0.3
+# requests made by the --http clients, with their relative weights
+http_operations = {"next": 4, "defer": 3, "add": 1, "list": 1, "stats": 1}
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(timings: list[float]) -> dict:
+    """Latency percentiles (ms) and throughput (ops/s) of a list of timings (s)."""
+    timings = sorted(timings)
+    total = sum(timings)
+    return {
+        "count": len(timings),
+        "mean_ms": total / len(timings) * 1000,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p90_ms": percentile(timings, 90) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "max_ms": timings[-1] * 1000,
+        "ops_per_sec": len(timings) / total if total else float("inf"),
+    }
+
+
+def make_tasks(rng: random.Random, count: int, start: int) -> list[Task]:
+    """Tasks with ids, titles, status and timestamps drawn from rng."""
+    base = datetime(2025, 1, 1)
+    tasks = []
+    for i in range(start, start + count):
+        created_at = base + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+        tasks.append(
+            Task(
+                id=UUID(int=rng.getrandbits(128), version=4),
+                title=f"benchmark task {i}",
+                is_completed=rng.random() < completed_ratio,
+                created_at=created_at,
+                last_deferred=created_at + timedelta(seconds=rng.randrange(3600)),
+            )
+        )
+    return tasks
+
+
+def populate(api: TaskAPI, rng: random.Random, size: int) -> list[UUID]:
+    ids = []
+    for start in range(0, size, populate_chunk_size):
+        count = min(populate_chunk_size, size - start)
+        ids.extend(api.add_tasks(make_tasks(rng, count, start)))
+    return ids
+
+
+def time_calls(call, args_list) -> list[float]:
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        call(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_benchmark(
+    size: int,
+    ops: int = 200,
+    heavy_ops: int = 5,
+    seed: int = 42,
+    api_options: dict | None = None,
+) -> list[dict]:
+    """Populate a new DB with size tasks, time every operation on it
+    and return one result dict per operation.
+    """
+    rng = random.Random(seed)
+    results = []
+    with TemporaryDirectory() as tmp_dir:
+        db_url = f"sqlite:///{Path(tmp_dir) / 'bench.sqlite3'}"
+        api = TaskAPI(db_url, **(api_options or {}))
+
+        start = time.perf_counter()
+        ids = populate(api, rng, size)
+        populate_seconds = time.perf_counter() - start
+
+        new_tasks = make_tasks(rng, ops, size)
+        sampled_ids = [rng.choice(ids) for _ in range(ops)]
+        calls = {
+            "add_task": (api.add_task, [(task,) for task in new_tasks]),
+            "defer_task": (api.defer_task, [(id,) for id in sampled_ids]),
+            "get_next_task": (api.get_next_task, [()] * ops),
+            "toggle_complete": (api.toggle_complete, [(id,) for id in sampled_ids]),
+            "list_all_tasks": (api.list_all_tasks, [()] * heavy_ops),
+            "count_tasks": (api.count_tasks, [()] * heavy_ops),
+            "delete_all_tasks": (api.delete_all_tasks, [()]),
+        }
+        for operation in operations:
+            call, args_list = calls[operation]
+            result = {"size": size, "operation": operation}
+            result.update(summarize(time_calls(call, args_list)))
+            results.append(result)
+        api.close()
+
+    for result in results:
+        result["populate_seconds"] = populate_seconds
+    return results
+
+
+def run_overhead_benchmark(ops: int = 2000, seed: int = 42) -> list[dict]:
+    """Time cheap calls on a small DB, where the time is mostly per call
+    overhead: a new Session and statement per call, TaskAPI's calls, and
+    TaskAPI's calls grouped 10 per unit of work.
+    """
+    rng = random.Random(seed)
+    results = []
+    with TemporaryDirectory() as tmp_dir:
+        api = TaskAPI(f"sqlite:///{Path(tmp_dir) / 'bench.sqlite3'}")
+        ids = populate(api, rng, 1000)
+        sampled_ids = [(rng.choice(ids),) for _ in range(ops)]
+        engine = api._engine
+
+        def new_session_get(id):
+            with Session(engine) as session:
+                return session.exec(select(Task).where(Task.id == id)).one()
+
+        def new_session_update(id):
+            with Session(engine) as session:
+                statement = update(Task).where(Task.id == id).values(title="renamed")
+                session.exec(statement.returning(Task)).scalars().one()
+                session.commit()
+
+        def grouped(call):
+            def run(id):
+                # 10 calls per unit of work, timed per call below
+                with api.unit_of_work():
+                    for _ in range(10):
+                        call(id)
+
+            return run
+
+        calls = {
+            "get:new_session": (new_session_get, sampled_ids),
+            "get:task_api": (api.get_task, sampled_ids),
+            "get:unit_of_work": (grouped(api.get_task), sampled_ids[: ops // 10]),
+            "update:new_session": (new_session_update, sampled_ids),
+            "update:task_api": (
+                lambda id: api.update_task_title(id, "renamed"),
+                sampled_ids,
+            ),
+            "update:unit_of_work": (
+                grouped(lambda id: api.update_task_title(id, "renamed")),
+                sampled_ids[: ops // 10],
+            ),
+        }
+        for operation, (call, args_list) in calls.items():
+            timings = time_calls(call, args_list)
+            if operation.endswith("unit_of_work"):
+                timings = [t / 10 for t in timings]
+            result = {"size": 1000, "operation": operation}
+            result.update(summarize(timings))
+            results.append(result)
+        api.close()
+    return results
+
+
+async def http_clients(url: str, ops: int, clients: int, seed: int) -> dict:
+    """Run clients concurrent clients making ops requests each to the server
+    at url. Return the timings of each operation and the total wall time.
+    """
+    import httpx
+
+    timings = {operation: [] for operation in http_operations}
+
+    async def request(client, operation, rng):
+        if operation == "defer":
+            # the next task, as a client skimming through them would
+            response = await client.get("/tasks/next")
+            if response.status_code == 404:
+                return
+            start = time.perf_counter()
+            response = await client.post(f"/tasks/{response.json()['id']}/defer")
+        else:
+            start = time.perf_counter()
+            if operation == "next":
+                response = await client.get("/tasks/next")
+            elif operation == "add":
+                title = f"http task {rng.getrandbits(32)}"
+                response = await client.post("/tasks", json={"title": title})
+            elif operation == "list":
+                response = await client.get("/tasks", params={"limit": 50})
+            else:
+                response = await client.get("/stats")
+        timings[operation].append(time.perf_counter() - start)
+        if response.status_code >= 500:
+            response.raise_for_status()
+
+    async def run_client(client, n):
+        rng = random.Random(seed + n)
+        names = list(http_operations)
+        weights = list(http_operations.values())
+        for _ in range(ops):
+            await request(client, rng.choices(names, weights)[0], rng)
+
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(base_url=url, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(run_client(client, n) for n in range(clients)))
+        wall_seconds = time.perf_counter() - start
+    return {"timings": timings, "wall_seconds": wall_seconds}
+
+
+def run_http_benchmark(
+    url: str, ops: int = 200, clients: int = 10, seed: int = 42
+) -> list[dict]:
+    """Load test the server at url, return one result dict per operation
+    ("size" is the number of clients) and one for all of them, its ops/s
+    being the server's throughput.
+    """
+    run = asyncio.run(http_clients(url, ops, clients, seed))
+    results = []
+    all_timings = []
+    for operation, timings in run["timings"].items():
+        if not timings:
+            continue
+        all_timings.extend(timings)
+        result = {"size": clients, "operation": f"http:{operation}"}
+        result.update(summarize(timings))
+        results.append(result)
+    result = {"size": clients, "operation": "http:all"}
+    result.update(summarize(all_timings))
+    result["ops_per_sec"] = len(all_timings) / run["wall_seconds"]
+    results.append(result)
+    return results
+
+
+def environment(args) -> dict:
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sqlite": sqlite3.sqlite_version,
+        "sqlalchemy": sqlalchemy.__version__,
+        "seed": args.seed,
+        "ops": args.ops,
+        "heavy_ops": args.heavy_ops,
+        "api_options": api_options(args),
+    }
+
+
+def api_options(args) -> dict:
+    return {
+        "cache_queue": args.cache_queue,
+        "profile": args.profile,
+        "compact": args.compact,
+    }
+
+
+def print_results(results: list[dict]) -> None:
+    print(
+        f"{'size':>9} {'operation':<18} {'p50 ms':>9} {'p90 ms':>9} "
+        f"{'p99 ms':>9} {'max ms':>9} {'ops/s':>10}"
+    )
+    for r in results:
+        print(
+            f"{r['size']:>9} {r['operation']:<18} {r['p50_ms']:>9.3f} "
+            f"{r['p90_ms']:>9.3f} {r['p99_ms']:>9.3f} {r['max_ms']:>9.3f} "
+            f"{r['ops_per_sec']:>10.1f}"
+        )
+
+
+def compare(old_path: Path, new_path: Path) -> None:
+    """Print the p50 latency change of every (size, operation) in both runs."""
+    old = {
+        (r["size"], r["operation"]): r
+        for r in json.loads(old_path.read_text())["results"]
+    }
+    new = json.loads(new_path.read_text())["results"]
+    print(f"{'size':>9} {'operation':<18} {'old p50':>9} {'new p50':>9} {'change':>8}")
+    for r in new:
+        before = old.get((r["size"], r["operation"]))
+        if before is None:
+            continue
+        change = (r["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+        print(
+            f"{r['size']:>9} {r['operation']:<18} {before['p50_ms']:>9.3f} "
+            f"{r['p50_ms']:>9.3f} {change:>+7.1f}%"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=default_sizes)
+    parser.add_argument("--ops", type=int, default=200)
+    parser.add_argument("--heavy-ops", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--profile", default=None)
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--cache-queue", action="store_true")
+    parser.add_argument(
+        "--overhead", action="store_true", help="time per call overhead"
+    )
+    parser.add_argument("--http", metavar="URL", help="load test a server")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--output", type=Path, help="write results as JSON")
+    parser.add_argument(
+        "--compare", type=Path, nargs=2, metavar=("OLD", "NEW"), help="compare runs"
+    )
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.http:
+        results = run_http_benchmark(args.http, args.ops, args.clients, args.seed)
+        print_results(results)
+    elif args.overhead:
+        results = run_overhead_benchmark(args.ops * 10, args.seed)
+        print_results(results)
+    else:
+        results = []
+        for size in args.sizes:
+            size_results = run_benchmark(
+                size, args.ops, args.heavy_ops, args.seed, api_options(args)
+            )
+            print_results(size_results)
+            results.extend(size_results)
+    if args.output:
+        report = {"environment": environment(args), "results": results}
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
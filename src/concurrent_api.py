@@ -0,0 +1,308 @@
+import random
+import sqlite3
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from copy import copy
+from datetime import datetime, timedelta
+from pathlib import Path
+from queue import Full, Queue
+from threading import Event, Lock, Thread
+from typing import Callable, TextIO
+from uuid import UUID
+
+from sqlalchemy.exc import OperationalError
+
+from api import ID_CHUNK_SIZE, TaskAPI, TaskException, TaskStats
+from models import ArchivedTask, Task, TaskRow, default_list_id
+from transfer import TransferStats
+
+# pending writes before submitting one blocks (or fails, see submit_timeout)
+write_queue_size = 1000
+readers = 4
+# retries of a call failing with SQLITE_BUSY, the first one after about
+# busy_backoff seconds, then twice as long every time (with some jitter)
+busy_retries = 5
+busy_backoff = 0.02
+
+
+class WriteQueueFull(TaskException):
+    pass
+
+
+def is_busy(error: Exception) -> bool:
+    """Whether error is SQLite's SQLITE_BUSY ("database is locked")."""
+    error = getattr(error, "orig", error)
+    return isinstance(error, sqlite3.OperationalError) and str(error) in (
+        "database is locked",
+        "database is busy",
+    )
+
+
+def call_with_retry(
+    method, *args, retries: int = busy_retries, backoff: float = busy_backoff
+):
+    """Call method(*args), again with an exponential backoff while it fails
+    with SQLITE_BUSY. The busy_timeout of the profiles covers waiting for
+    a lock, this covers what it can't: a read transaction upgraded to a
+    write one while another connection wrote (which fails at once) and
+    locks held longer than the timeout.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return method(*args)
+        except OperationalError as e:
+            if attempt == retries or not is_busy(e):
+                raise
+            time.sleep(backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+
+class ConcurrentTaskAPI:
+    """Thread-safe version of TaskAPI, for several threads (or background
+    jobs) sharing one DB.
+
+    Every write is queued to a single writer thread (at most
+    write_queue_size pending, see submit_timeout), reads run on a pool of
+    reader threads, each with its own session. The DB uses WAL (the
+    "balanced" profile by default) so readers see the last committed
+    state without waiting on the writer. Calls failing with SQLITE_BUSY
+    are retried, see call_with_retry().
+
+    Every method returns a concurrent.futures.Future of the TaskAPI
+    method's result. Writes are applied in the order they were submitted;
+    a read submitted once a write's future is done sees it.
+    The wrapped TaskAPI is available as `sync`.
+    """
+
+    def __init__(
+        self,
+        db_url,
+        cache_queue: bool = False,
+        profile: str | None = "balanced",
+        compact: bool = False,
+        instrument: bool = False,
+        list_id: str = default_list_id,
+        shards: bool = False,
+        readers: int = readers,
+        write_queue_size: int = write_queue_size,
+        submit_timeout: float | None = None,
+    ):
+        self.db_url = db_url
+        self.sync = TaskAPI(
+            db_url,
+            cache_queue=cache_queue,
+            profile=profile,
+            compact=compact,
+            instrument=instrument,
+            list_id=list_id,
+            shards=shards,
+        )
+        self.submit_timeout = submit_timeout
+        self._writes = Queue(maxsize=write_queue_size)
+        self._writer = Thread(
+            target=self._write_loop, name="task-writer", daemon=True
+        )
+        self._writer.start()
+        self._readers = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix="task-reader"
+        )
+        # shared with the APIs of the other lists, see for_list()
+        self._closed = Event()
+        self._close_lock = Lock()
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._writes.get()
+            if item is None:
+                return
+            future, method, args, retry = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if retry:
+                    future.set_result(call_with_retry(method, *args))
+                else:
+                    future.set_result(method(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _write(self, method, *args, retry: bool = True) -> Future:
+        """Queue method(*args) to the writer thread. Blocks while the queue
+        is full, up to submit_timeout (then raises WriteQueueFull).
+        """
+        future = Future()
+        with self._close_lock:
+            if self._closed.is_set():
+                raise RuntimeError("cannot submit a write after close()")
+            try:
+                item = (future, method, args, retry)
+                self._writes.put(item, timeout=self.submit_timeout)
+            except Full:
+                raise WriteQueueFull(
+                    f"[Error] {self._writes.maxsize} writes pending, try again later"
+                )
+        return future
+
+    def _read(self, method, *args, retry: bool = True) -> Future:
+        if retry:
+            return self._readers.submit(call_with_retry, method, *args)
+        return self._readers.submit(method, *args)
+
+    def close(self) -> None:
+        """Wait for the pending writes and reads, stop the threads and close
+        the API, of every list.
+        """
+        with self._close_lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+        self._writes.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+        self.sync.close()
+
+    def unit_of_work(self, work: Callable[[TaskAPI], object]) -> Future:
+        """Run work(sync) on the writer thread in a single transaction (see
+        TaskAPI.unit_of_work()), retried as a whole on SQLITE_BUSY.
+        """
+
+        def run():
+            with self.sync.unit_of_work():
+                return work(self.sync)
+
+        return self._write(run)
+
+    def for_list(self, list_id: str) -> "ConcurrentTaskAPI":
+        """ConcurrentTaskAPI of another list (see TaskAPI.for_list()),
+        sharing this one's writer and reader threads.
+        """
+        api = copy(self)
+        api.sync = self.sync.for_list(list_id)
+        return api
+
+    def subscribe(self, callback):
+        """See TaskAPI.subscribe(), callback runs in the writer thread."""
+        return self.sync.subscribe(callback)
+
+    def add_task(self, task: Task) -> Future[UUID]:
+        return self._write(self.sync.add_task, task)
+
+    def add_tasks(self, tasks: list[Task]) -> Future[list[UUID]]:
+        return self._write(self.sync.add_tasks, tasks)
+
+    def list_all_tasks(self) -> Future[list[Task]]:
+        return self._read(self.sync.list_all_tasks)
+
+    def list_tasks(
+        self, after: Task | None = None, limit: int = 50, status: str = "all"
+    ) -> Future[list[Task]]:
+        return self._read(self.sync.list_tasks, after, limit, status)
+
+    def list_task_rows(
+        self,
+        after: Task | TaskRow | None = None,
+        limit: int | None = None,
+        status: str = "all",
+    ) -> Future[list[TaskRow]]:
+        return self._read(self.sync.list_task_rows, after, limit, status)
+
+    def search_tasks(
+        self, query: str, limit: int = 50, status: str = "all"
+    ) -> Future[list[TaskRow]]:
+        return self._read(self.sync.search_tasks, query, limit, status)
+
+    def export_tasks(
+        self,
+        stream: TextIO,
+        format: str = "jsonl",
+        status: str = "all",
+        batch_size: int = 1000,
+    ) -> Future[TransferStats]:
+        # not retried: part of the tasks may already be written to stream
+        return self._read(
+            self.sync.export_tasks, stream, format, status, batch_size, retry=False
+        )
+
+    def import_tasks(
+        self, stream: TextIO, format: str = "jsonl", chunk_size: int = 10_000
+    ) -> Future[TransferStats]:
+        # not retried: the chunks before a busy one are committed and read
+        return self._write(
+            self.sync.import_tasks, stream, format, chunk_size, retry=False
+        )
+
+    def backup(self, path: Path | str) -> Future[Path]:
+        # not retried: the backup API restarts the copy itself after a write
+        return self._read(self.sync.backup, path, retry=False)
+
+    def restore(self, path: Path | str) -> Future[None]:
+        # the reads in progress finish first, the new ones wait for it
+        return self._write(self.sync.restore, path, retry=False)
+
+    def snapshot(self, directory: Path | str | None = None) -> Future[Path]:
+        return self._read(self.sync.snapshot, directory, retry=False)
+
+    def list_incomplet_by_last_deferred(self) -> Future[list[Task]]:
+        return self._read(self.sync.list_incomplet_by_last_deferred)
+
+    def list_completed_tasks(self) -> Future[list[Task]]:
+        return self._read(self.sync.list_completed_tasks)
+
+    def list_incomplete_tasks(self) -> Future[list[Task]]:
+        return self._read(self.sync.list_incomplete_tasks)
+
+    def get_task(self, id: UUID) -> Future[Task]:
+        return self._read(self.sync.get_task, id)
+
+    def update_task_title(self, id: UUID, title: str) -> Future[Task]:
+        return self._write(self.sync.update_task_title, id, title)
+
+    def delete_task(self, id: UUID) -> Future[None]:
+        return self._write(self.sync.delete_task, id)
+
+    def defer_task(self, id: UUID) -> Future[None]:
+        return self._write(self.sync.defer_task, id)
+
+    def get_next_task(self) -> Future[Task]:
+        return self._read(self.sync.get_next_task)
+
+    def toggle_complete(self, id: UUID) -> Future[Task]:
+        return self._write(self.sync.toggle_complete, id)
+
+    def defer_tasks(self, ids: list[UUID | str]) -> Future[int]:
+        return self._write(self.sync.defer_tasks, ids)
+
+    def set_completed_many(
+        self, ids: list[UUID | str], completed: bool = True
+    ) -> Future[int]:
+        return self._write(self.sync.set_completed_many, ids, completed)
+
+    def delete_tasks(self, ids: list[UUID | str]) -> Future[int]:
+        return self._write(self.sync.delete_tasks, ids)
+
+    def clear_completed(self) -> Future[int]:
+        return self._write(self.sync.clear_completed)
+
+    def archive_completed(
+        self, older_than: timedelta | datetime, batch_size: int = ID_CHUNK_SIZE
+    ) -> Future[int]:
+        return self._write(self.sync.archive_completed, older_than, batch_size)
+
+    def list_archived_tasks(
+        self, after: ArchivedTask | None = None, limit: int = 50
+    ) -> Future[list[ArchivedTask]]:
+        return self._read(self.sync.list_archived_tasks, after, limit)
+
+    def count_archived_tasks(self) -> Future[int]:
+        return self._read(self.sync.count_archived_tasks)
+
+    def restore_task(self, id: UUID | str) -> Future[Task]:
+        return self._write(self.sync.restore_task, id)
+
+    def count_tasks(self) -> Future[int]:
+        return self._read(self.sync.count_tasks)
+
+    def task_stats(self) -> Future[TaskStats]:
+        return self._read(self.sync.task_stats)
+
+    def delete_all_tasks(self) -> Future[None]:
+        return self._write(self.sync.delete_all_tasks)
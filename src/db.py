@@ -1,10 +1,21 @@
 from sqlmodel import SQLModel, create_engine
-from sqlalchemy import inspect
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from sqlalchemy.exc import OperationalError as sqlalchemy_op_err
 from sqlite3 import OperationalError as sqlite_op_err
 from pathlib import Path
 from platformdirs import user_data_path
 
+from migrations import (
+    create_task_search,
+    migrate,
+    migrate_to_compact,
+    schema_version,
+    set_user_version,
+    transaction,
+    uses_compact_storage,
+)
+
 
 class DBException(Exception):
     pass
@@ -14,6 +25,10 @@ class DBConnectionFaild(DBException):
     pass
 
 
+class InvalidDBProfile(DBException):
+    pass
+
+
 appname = "kute-task"
 appauthor = "kute-apps"
 base_dir = Path(user_data_path(appname, appauthor))
@@ -21,22 +36,137 @@ base_dir = Path(user_data_path(appname, appauthor))
 sqlite_file_name = ".tasks_db.sqlite3"
 db_path = base_dir / sqlite_file_name
 sqlite_url = f"sqlite:///{db_path}"
+# directories of the per list DB files and of the backups, next to the
+# main DB file (see shard_dir() and backup_dir())
+shard_dir_name = "lists"
+backup_dir_name = "backups"
+
+# performance profiles: PRAGMAs set on every new SQLite connection.
+# cache_size is negative to mean KiB, mmap_size is in bytes, busy_timeout in ms.
+# - durable: WAL but still fsync on every commit (synchronous=FULL)
+# - balanced: WAL + synchronous=NORMAL, a commit can only be lost on power loss
+#   or OS crash (never corrupts the DB), no fsync on the UI path
+# - fast: no fsync at all, for throwaway/test DBs and bulk imports
+profiles = {
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 5000,
+    },
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -8000,
+        "mmap_size": 64 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -32000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
 
+def set_profile_pragmas(engine, profile: str) -> None:
+    """Register a connect hook on the engine applying the profile's PRAGMAs."""
+    if profile not in profiles:
+        raise InvalidDBProfile(
+            f"[Error] unknown DB profile: {profile}. Use one of: {list(profiles)}"
+        )
+    pragmas = profiles[profile]
 
-def get_engine(db_url: str = sqlite_url):
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
+def get_engine(
+    db_url: str = sqlite_url, profile: str | None = None, compact: bool = False
+):
     """Creates DB base_dir, create the SQLModel engine
-    then checks if database & table(s) exist, if not creates them
+    then checks if database & table(s) exist, if not creates them.
+    An existing DB created by an older version (as told by its
+    PRAGMA user_version) is upgraded, see migrations.py.
+    If a profile (see `profiles`) is given, its PRAGMAs are set on each connection,
+    otherwise SQLite defaults are used.
+    With compact=True a new DB is created with the compact storage format
+    (see models.CompactUUID and models.CompactDateTime) and an existing one
+    is migrated to it. An existing compact DB is always opened as compact.
     """
     base_dir.mkdir(exist_ok=True)
     try:
         engine = create_engine(db_url, echo=False)
-        insp = inspect(engine)
-        db_table_exists = insp.has_table("task")
+        if profile is not None:
+            set_profile_pragmas(engine, profile)
+        db_version, task_columns, archive_columns = read_schema_state(engine)
     except sqlalchemy_op_err as e:
         raise DBConnectionFaild(f"[Error] Faild to create or connect to the DB: {e}")
     except sqlite_op_err as e:
         raise DBConnectionFaild(f"Faild to create or connect to the DB: {e}")
 
-    if not db_table_exists:
-        SQLModel.metadata.create_all(engine)
+    if not task_columns:
+        engine.dialect.compact_storage = compact
+        with transaction(engine) as conn:
+            SQLModel.metadata.create_all(conn)
+            create_task_search(conn)
+            set_user_version(conn, schema_version)
+    else:
+        engine.dialect.compact_storage = uses_compact_storage(task_columns)
+        if db_version < schema_version:
+            migrate(engine, db_version)
+        # the task table is rewritten first, the archive may be left over
+        # by an interrupted migration
+        interrupted = (
+            engine.dialect.compact_storage
+            and archive_columns
+            and not uses_compact_storage(archive_columns)
+        )
+        if (compact and not engine.dialect.compact_storage) or interrupted:
+            migrate_to_compact(engine)
     return engine
+
+
+def db_file(db_url: str) -> Path:
+    return Path(make_url(db_url).database)
+
+
+def shard_dir(db_url: str) -> Path:
+    """Directory of the per list DB files of the DB at db_url: `lists` next
+    to it (in base_dir for the app's DB).
+    """
+    return db_file(db_url).parent / shard_dir_name
+
+
+def backup_dir(db_url: str) -> Path:
+    """Default directory of the snapshots of the DB at db_url."""
+    return db_file(db_url).parent / backup_dir_name
+
+
+def shard_db_url(shards: Path, list_id: str) -> str:
+    """URL of the DB file of a list in the shards directory. list_id must
+    be a checked one (see api.check_list_id), it's used as the file name.
+    """
+    shards.mkdir(parents=True, exist_ok=True)
+    return f"sqlite:///{shards / f'{list_id}.sqlite3'}"
+
+
+def read_schema_state(engine) -> tuple[int, list, list]:
+    """Return the DB's schema version, its task and archive table columns
+    (empty if the table doesn't exist), with a single connection.
+    """
+    with engine.connect() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        columns = conn.exec_driver_sql("PRAGMA table_info(task)").all()
+        archive_columns = conn.exec_driver_sql("PRAGMA table_info(task_archive)").all()
+    return version, columns, archive_columns
@@ -0,0 +1,76 @@
+import logging
+from enum import Enum
+from threading import Lock
+from typing import Callable, NamedTuple
+from uuid import UUID
+
+from models import Task
+
+logger = logging.getLogger("kute_task.events")
+
+
+class TaskEventKind(str, Enum):
+    ADDED = "added"
+    UPDATED = "updated"
+    DEFERRED = "deferred"
+    COMPLETED = "completed"
+    REOPENED = "reopened"
+    DELETED = "deleted"
+    ALL_DELETED = "all_deleted"
+    # moved to / back from the archive table, see TaskAPI.archive_completed()
+    ARCHIVED = "archived"
+    RESTORED = "restored"
+    # tasks added by TaskAPI.import_tasks(), too many for an event each
+    IMPORTED = "imported"
+    # every task replaced by the content of a backup, see TaskAPI.restore()
+    REPLACED = "replaced"
+
+
+class TaskEvent(NamedTuple):
+    """A change to one task, published by TaskAPI after it's committed.
+    task is the task's new state (its last one for DELETED and ARCHIVED),
+    task_id and task are None for ALL_DELETED, IMPORTED and REPLACED.
+    """
+
+    kind: TaskEventKind
+    task_id: UUID | None
+    task: Task | None = None
+
+
+class TaskEvents:
+    """Subscribers of the task change events of a TaskAPI.
+
+    Callbacks run in the thread that made the change (AsyncTaskAPI's worker
+    thread for the UI), right after the change is committed. A failing
+    callback is logged and doesn't stop the others.
+    """
+
+    def __init__(self):
+        self._subscribers = []
+        self._lock = Lock()
+
+    def subscribe(self, callback: Callable[[TaskEvent], None]) -> Callable[[], None]:
+        """Call callback with every TaskEvent. Return a function unsubscribing it."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+
+        return unsubscribe
+
+    def publish(
+        self, kind: TaskEventKind, task_id: UUID | None, task: Task | None = None
+    ) -> None:
+        if not self._subscribers:
+            return
+        event = TaskEvent(kind, task_id, task)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception("task event subscriber failed on %s", event)
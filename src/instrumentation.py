@@ -0,0 +1,160 @@
+import json
+import logging
+import time
+from bisect import bisect_left
+from functools import wraps
+from pathlib import Path
+from threading import Event, Lock, Thread, local
+
+from sqlalchemy import event
+
+logger = logging.getLogger("kute_task.stats")
+
+# upper bounds (ms) of the wall time histogram buckets, plus one overflow bucket
+histogram_bounds_ms = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+# name used for SQL statements run outside of any instrumented method
+outside_methods = "<engine>"
+
+
+def new_method_stats() -> dict:
+    return {
+        "calls": 0,
+        "errors": 0,
+        "total_ms": 0.0,
+        "max_ms": 0.0,
+        "histogram": [0] * (len(histogram_bounds_ms) + 1),
+        "statements": 0,
+        "rows_returned": 0,
+        "rows_affected": 0,
+    }
+
+
+def returned_rows(result) -> int:
+    """Rough count of the rows a method returned: a list's length,
+    0 for None and 1 for anything else (a task, an id, a count...).
+    """
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+class Instrumentation:
+    """Call counts, wall time histograms, SQL statements and rows
+    recorded per TaskAPI method.
+
+    SQL statements are counted by an engine event hook and attributed to
+    the instrumented method running in the same thread (innermost one when
+    methods call each other).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._methods = {}
+        self._running = local()
+
+    def attach(self, engine) -> None:
+        event.listen(engine, "after_cursor_execute", self._statement_executed)
+
+    def detach(self, engine) -> None:
+        event.remove(engine, "after_cursor_execute", self._statement_executed)
+
+    def _stats(self, name: str) -> dict:
+        stats = self._methods.get(name)
+        if stats is None:
+            stats = self._methods[name] = new_method_stats()
+        return stats
+
+    def _statement_executed(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        name = getattr(self._running, "method", None) or outside_methods
+        with self._lock:
+            stats = self._stats(name)
+            stats["statements"] += 1
+            if cursor.rowcount > 0:
+                stats["rows_affected"] += cursor.rowcount
+
+    def call(self, name: str, method, *args, **kwargs):
+        """Run method, recording its wall time, result rows and errors under name."""
+        outer_method = getattr(self._running, "method", None)
+        self._running.method = name
+        start = time.perf_counter()
+        failed = False
+        result = None
+        try:
+            result = method(*args, **kwargs)
+            return result
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self._running.method = outer_method
+            with self._lock:
+                stats = self._stats(name)
+                stats["calls"] += 1
+                stats["errors"] += failed
+                stats["total_ms"] += elapsed_ms
+                stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+                stats["histogram"][bisect_left(histogram_bounds_ms, elapsed_ms)] += 1
+                stats["rows_returned"] += returned_rows(result)
+
+    def snapshot(self) -> dict:
+        """Copy of the stats recorded so far, keyed by method name."""
+        labels = [f"<={bound}" for bound in histogram_bounds_ms]
+        labels.append(f">{histogram_bounds_ms[-1]}")
+        with self._lock:
+            snapshot = {}
+            for name, stats in self._methods.items():
+                method_snapshot = dict(stats)
+                method_snapshot["mean_ms"] = (
+                    stats["total_ms"] / stats["calls"] if stats["calls"] else 0.0
+                )
+                method_snapshot["histogram_ms"] = dict(zip(labels, stats["histogram"]))
+                del method_snapshot["histogram"]
+                snapshot[name] = method_snapshot
+            return snapshot
+
+    def reset(self) -> None:
+        with self._lock:
+            self._methods.clear()
+
+    def dump(self, path: Path | None = None) -> None:
+        """Write a snapshot as JSON to path, or log it if no path is given."""
+        data = json.dumps(self.snapshot(), indent=2)
+        if path is None:
+            logger.info("TaskAPI stats: %s", data)
+            return
+        tmp_path = Path(path).with_suffix(".tmp")
+        tmp_path.write_text(data)
+        tmp_path.replace(path)
+
+    def start_periodic_dump(self, interval: float, path: Path | None = None):
+        """Dump a snapshot every interval seconds from a background thread.
+        Return a function that stops it.
+        """
+        stopped = Event()
+
+        def run():
+            while not stopped.wait(interval):
+                self.dump(path)
+
+        Thread(target=run, name="task-api-stats", daemon=True).start()
+        return stopped.set
+
+
+def instrumented(method):
+    """Record the calls of a TaskAPI method in the API's Instrumentation.
+    When instrumentation is disabled this is a single attribute check.
+    """
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.instrumentation is None:
+            return method(self, *args, **kwargs)
+        return self.instrumentation.call(name, method, self, *args, **kwargs)
+
+    return wrapper
@@ -1,8 +1,15 @@
+import time
+
+# start of the startup timing (see KUTE_STARTUP_TIMING in main())
+startup_started = time.perf_counter()
+
+import os
+from datetime import timedelta
+
 import flet as ft
-from api import TaskAPI
-from db import sqlite_url
-from models import Task
-from task_list_view import ListTasksView
+from async_api import AsyncTaskAPI
+from db import base_dir, sqlite_url
+from events import TaskEventKind
 
 
 class Drawer(ft.NavigationDrawer):
@@ -40,6 +47,12 @@ class Drawer(ft.NavigationDrawer):
         ]
 
 
+# completed tasks are moved to the archive this long after being completed,
+# see TaskAPI.archive_completed()
+archive_completed_after = timedelta(days=30)
+# a snapshot of the DB is taken this often, see TaskAPI.start_snapshots()
+snapshot_interval = 24 * 3600
+
 # info for /about view
 about = {
     "name": "Kute Task",
@@ -50,6 +63,18 @@ about = {
     "supportme_url": "https://buymeacoffee.com/ahmedlemine",
 }
 
+# changes to a task that can't make it the next task in the queue
+# (unlike an added or reopened one)
+other_task_changes = (
+    TaskEventKind.UPDATED,
+    TaskEventKind.DEFERRED,
+    TaskEventKind.COMPLETED,
+    TaskEventKind.DELETED,
+    # only completed tasks are archived and restored
+    TaskEventKind.ARCHIVED,
+    TaskEventKind.RESTORED,
+)
+
 
 class MainApp(ft.View):
     def __init__(self, api, page):
@@ -57,7 +82,6 @@ class MainApp(ft.View):
         self.api = api
         page.on_route_change = self.route_change
         self.drawer = Drawer(self.handle_drwr_change)
-        self.task_list = self.get_task_list_from_db()
         self.routes = ["/", "/focus", "/list", "/settings", "/about"]
         self.single_task_item = self.get_single_task_item()
         self.current_focus_task = None
@@ -131,9 +155,7 @@ class MainApp(ft.View):
                     [
                         ft.ElevatedButton(
                             "Defer",
-                            on_click=lambda e: self.defer_task(
-                                self.get_single_task_item(), e
-                            ),
+                            on_click=self.defer_clicked,
                             width=200,
                             style=ft.ButtonStyle(
                                 padding=20,
@@ -151,7 +173,7 @@ class MainApp(ft.View):
             ],
             expand=True,
             alignment=ft.CrossAxisAlignment.CENTER,
-            visible=self.get_single_task_item() is not None,
+            visible=self.single_task_item is not None,
         )
 
         self.current_task_display = ft.Text(
@@ -240,7 +262,7 @@ class MainApp(ft.View):
             ],
             expand=True,
             alignment=ft.CrossAxisAlignment.CENTER,
-            visible=self.get_single_task_item() is None,
+            visible=self.single_task_item is None,
         )
         # /focus View
         self.focus_mode_title = ft.Text(
@@ -267,11 +289,10 @@ class MainApp(ft.View):
             alignment=ft.CrossAxisAlignment.CENTER,
         )
 
-        # /list: Task list view:
-        self.task_list_control = ListTasksView(
-            get_task_list_from_db=self.get_task_list_from_db
-        )
-        self.task_list_view = ft.Row([self.task_list_control])
+        # /list: Task list view, created the first time /list is opened
+        # (see load_task_list_control())
+        self.task_list_control = None
+        self.task_list_view = ft.Row([])
 
         # /settings View
         self.settings_view = ft.Column(
@@ -441,30 +462,61 @@ class MainApp(ft.View):
             ),
         }
 
-    def get_task_list_from_db(self):
-        task_list_from_db = self.api.list_all_tasks()
-        if len(task_list_from_db) > 0:
-            return task_list_from_db
-        else:
-            return []
+        # keeps the next task shown on the home view up to date
+        self.api.subscribe(self.task_changed)
 
-    def set_task_list(self):
-        self.task_list = self.get_task_list_from_db()
+    def load_task_list_control(self):
+        """Create the task list view on first use, keeping its import
+        and first page query off the startup path.
+        """
+        if self.task_list_control is None:
+            from task_list_view import ListTasksView
 
-    def set_single_task_item(self):
-        self.single_task_item = self.get_single_task_item()
+            self.task_list_control = ListTasksView(api=self.api)
+            self.task_list_view.controls.append(self.task_list_control)
 
     def get_single_task_item(self):
-        return self.api.get_next_task() or None
+        return self.api.sync.get_next_task() or None
 
-    def defer_task(self, task, e):
-        self.api.defer_task(str(task.id))
+    def show_next_task(self):
+        self.single_task_item = self.get_single_task_item()
+        has_task = self.single_task_item is not None
+        if has_task:
+            self.single_task_display_text.value = self.single_task_item.title
+        self.select_task_view.visible = has_task
+        self.empty_tasks_home_view.visible = not has_task
+
+    def task_changed(self, event):
+        """Update the home and focus views after a change to a task.
+        The next task is only looked up again if the change can affect it.
+        """
+        focus_task = self.current_focus_task
+        if (
+            focus_task is not None
+            and event.task_id == focus_task.id
+            and event.kind == TaskEventKind.UPDATED
+        ):
+            self.current_focus_task = event.task
+            self.current_task_display.value = event.task.title
+        next_task = self.single_task_item
+        if (
+            next_task is not None
+            and event.task_id != next_task.id
+            and event.kind in other_task_changes
+        ):
+            return
+        self.show_next_task()
+
+    async def defer_clicked(self, e):
+        await self.defer_task(self.single_task_item, e)
+
+    async def defer_task(self, task, e):
+        await self.api.defer_task(task.id)
         e.page.open(ft.SnackBar(ft.Text(f"Deferred: {task.title}")))
-        self.single_task_display_text.value = self.get_single_task_item().title
         e.page.update()
 
     def set_current_focus_task(self, e):
-        current_task = self.get_single_task_item()
+        current_task = self.single_task_item
         self.current_focus_task = current_task
         e.page.open(ft.SnackBar(ft.Text(f"Set Current task: {current_task.title}")))
 
@@ -476,9 +528,9 @@ class MainApp(ft.View):
         e.page.go("/focus")
         e.page.update()
 
-    def finish_current_task(self, e):
+    async def finish_current_task(self, e):
         task_to_finish = self.current_focus_task
-        self.api.toggle_complete(str(task_to_finish.id))
+        await self.api.toggle_complete(task_to_finish.id)
         e.page.open(ft.SnackBar(ft.Text(f"Win! You completed: {task_to_finish.title}")))
 
         self.current_focus_task = None
@@ -486,14 +538,7 @@ class MainApp(ft.View):
         self.current_task_done_btn.visible = False
         self.focus_mode_title.visible = False
         self.empty_current_task_view.visible = True
-        self.task_list_control.build()
-
-        if self.get_single_task_item() is not None:
-            self.single_task_item = self.get_single_task_item()
-            self.single_task_display_text.value = self.single_task_item.title
-        else:
-            self.select_task_view.visible = False
-            self.empty_tasks_home_view.visible = True
+        if self.single_task_item is None:
             e.page.open(ft.SnackBar(ft.Text("Win: you completed all tasks!")))
 
         e.page.update()
@@ -515,26 +560,17 @@ class MainApp(ft.View):
     def route_change(self, route):
         page = route.page
         if page is not None:
+            # write the deferrals made on the previous view
+            page.run_task(self.api.flush)
             page.views.clear()
-            if page.route == "/":
-                if self.get_single_task_item() is not None:
-                    self.single_task_item = self.get_single_task_item()
-                    self.single_task_display_text.value = self.single_task_item.title
-                    self.select_task_view.visible = True
-                    self.empty_tasks_home_view.visible = False
-                else:
-                    self.select_task_view.visible = False
-                    self.empty_tasks_home_view.visible = True
+            if page.route == "/list":
+                self.load_task_list_control()
             page.views.append(self.page_views[page.route])
             page.update()
 
     def open_bmc_url(self, e, url):
         e.page.launch_url(url)
 
-    def before_update(self):
-        self.set_single_task_item()
-        self.set_task_list()
-
 
 def main(page: ft.Page):
     page.title = "Kute Task"
@@ -552,7 +588,26 @@ def main(page: ft.Page):
 
     page.scroll = ft.ScrollMode.ADAPTIVE
 
-    api = TaskAPI(db_url=sqlite_url)
+    # KUTE_STARTUP_TIMING=1 prints how long startup took up to the first task
+    startup_timing = bool(os.environ.get("KUTE_STARTUP_TIMING"))
+    main_started = time.perf_counter()
+
+    # KUTE_TASK_STATS=<seconds> turns on TaskAPI instrumentation and writes
+    # its stats to task_api_stats.json (in the app's data dir) every <seconds>
+    stats_interval = os.environ.get("KUTE_TASK_STATS")
+    api = AsyncTaskAPI(
+        db_url=sqlite_url,
+        cache_queue=True,
+        profile="balanced",
+        instrument=bool(stats_interval),
+        write_behind=True,
+    )
+    if stats_interval:
+        api.sync.instrumentation.start_periodic_dump(
+            float(stats_interval), base_dir / "task_api_stats.json"
+        )
+
+    api_ready = time.perf_counter()
 
     def view_pop(view):
         page.views.pop()
@@ -562,9 +617,33 @@ def main(page: ft.Page):
     main_app = MainApp(api=api, page=page)
     page.add(main_app)
 
+    def flush_deferrals(e):
+        page.run_task(api.flush)
+
     page.on_view_pop = view_pop
     page.on_route_change = main_app.route_change
+    # when the app goes to the background (mobile) or the session ends
+    page.on_app_lifecycle_state_change = flush_deferrals
+    stop_snapshots = api.sync.start_snapshots(snapshot_interval)
+
+    def close(e):
+        stop_snapshots()
+        api.close()
+
+    page.on_close = close
     page.go(page.route)
+    # off the startup path, once the first task is shown
+    page.run_task(api.archive_completed, archive_completed_after)
+
+    if startup_timing:
+        first_task_shown = time.perf_counter()
+        print(
+            "startup timing: "
+            f"imports {(main_started - startup_started) * 1000:.1f}ms, "
+            f"page setup + db {(api_ready - main_started) * 1000:.1f}ms, "
+            f"first task {(first_task_shown - api_ready) * 1000:.1f}ms, "
+            f"time to first task {(first_task_shown - startup_started) * 1000:.1f}ms"
+        )
 
 
 ft.app(main, view=ft.AppView.WEB_BROWSER)
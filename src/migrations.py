@@ -0,0 +1,282 @@
+"""Schema migrations, applied by db.get_engine when a DB file is opened.
+
+The schema version of a DB file is its PRAGMA user_version. Each migration
+upgrades the schema from the previous version to its own, they're applied
+in order, each in its own transaction which also bumps user_version, so
+a failed step leaves the DB at the last version that was fully applied.
+
+A migration is either a plain step, a function run with the transaction's
+connection, or a table rewrite (rewrite=True), a function converting each
+stored value that rewrite_task_table() applies to every row in batches.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy import MetaData
+
+from models import (
+    ArchivedTask,
+    CompactDateTime,
+    CompactUUID,
+    Task,
+    default_list_id,
+    epoch,
+    one_microsecond,
+)
+
+# suffix of the name of the table rows are copied into by rewrite_task_table()
+rebuild_table_suffix = "_rebuild"
+# rows copied per transaction by rewrite_task_table()
+rewrite_batch_size = 5000
+
+# (version, function, rewrite), in version order. see migration()
+migrations = []
+
+
+def migration(version: int, rewrite: bool = False):
+    """Register a migration upgrading the schema to version."""
+
+    def register(function):
+        migrations.append((version, function, rewrite))
+        return function
+
+    return register
+
+
+@contextmanager
+def transaction(engine):
+    """Connection in an explicit SQLite transaction, DDL included.
+    (the sqlite3 driver would otherwise run DDL statements outside of it)
+    Committed on exit, rolled back on error.
+    """
+    with engine.begin() as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        yield conn
+
+
+def set_user_version(conn, version: int) -> None:
+    conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def latest_version() -> int:
+    return migrations[-1][0]
+
+
+def migrate(engine, db_version: int, batch_size: int = rewrite_batch_size) -> None:
+    """Apply, in order, every migration newer than db_version."""
+    for version, function, rewrite in migrations:
+        if version <= db_version:
+            continue
+        if rewrite:
+            rewrite_task_table(engine, function, batch_size, version)
+        else:
+            with transaction(engine) as conn:
+                function(conn)
+                set_user_version(conn, version)
+
+
+def rewrite_task_table(
+    engine,
+    convert_value,
+    batch_size: int = rewrite_batch_size,
+    version=None,
+    table=Task.__table__,
+) -> None:
+    """Rebuild the task table (or another model's table) with the current
+    model definition, passing every stored value through
+    convert_value(value, column).
+
+    Rows are copied into a new table batch_size at a time, each batch in
+    its own transaction, so memory use and the time the DB stays locked are
+    bounded by the batch size. Rowids are kept. The old table is then
+    replaced by the new one and the indexes are created in a last
+    transaction, which also sets user_version to version if given.
+    Rows written to the task table while it's being copied may be lost,
+    so it should only run at startup, before the DB is used.
+    """
+    columns = list(table.columns)
+    column_names = ", ".join(column.name for column in columns)
+    placeholders = ", ".join("?" * (len(columns) + 1))
+    rebuild_table_name = table.name + rebuild_table_suffix
+    rebuild_table = table.to_metadata(MetaData(), name=rebuild_table_name)
+    rebuild_table.indexes.clear()
+
+    with transaction(engine) as conn:
+        # left over by an interrupted rewrite, start over
+        rebuild_table.drop(conn, checkfirst=True)
+        rebuild_table.create(conn)
+
+    last_rowid = 0
+    while True:
+        with transaction(engine) as conn:
+            batch = conn.exec_driver_sql(
+                f"SELECT rowid, {column_names} FROM {table.name} "
+                "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size),
+            ).all()
+            if not batch:
+                break
+            rows = [
+                (rowid, *map(convert_value, values, columns))
+                for rowid, *values in batch
+            ]
+            conn.exec_driver_sql(
+                f"INSERT INTO {rebuild_table_name} (rowid, {column_names}) "
+                f"VALUES ({placeholders})",
+                rows,
+            )
+        last_rowid = batch[-1][0]
+
+    with transaction(engine) as conn:
+        conn.exec_driver_sql(f"DROP TABLE {table.name}")
+        conn.exec_driver_sql(f"ALTER TABLE {rebuild_table_name} RENAME TO {table.name}")
+        for index in table.indexes:
+            index.create(conn)
+        # the search triggers were dropped with the old task table
+        if table is Task.__table__ and has_task_search(conn):
+            create_task_search_triggers(conn)
+            conn.exec_driver_sql("INSERT INTO task_fts(task_fts) VALUES ('rebuild')")
+        if version is not None:
+            set_user_version(conn, version)
+
+
+def has_task_search(conn) -> bool:
+    """Whether the DB has the task_fts search table (see create_task_search())."""
+    return (
+        conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'task_fts'"
+        ).first()
+        is not None
+    )
+
+
+# keep task_fts in sync with the task table. an external content FTS5 table
+# is told the old values of a row to remove it from the index
+task_search_triggers = (
+    """CREATE TRIGGER IF NOT EXISTS task_fts_insert AFTER INSERT ON task BEGIN
+        INSERT INTO task_fts(rowid, title) VALUES (new.rowid, new.title);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_fts_delete AFTER DELETE ON task BEGIN
+        INSERT INTO task_fts(task_fts, rowid, title)
+        VALUES ('delete', old.rowid, old.title);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_fts_update AFTER UPDATE OF title ON task BEGIN
+        INSERT INTO task_fts(task_fts, rowid, title)
+        VALUES ('delete', old.rowid, old.title);
+        INSERT INTO task_fts(rowid, title) VALUES (new.rowid, new.title);
+    END""",
+)
+
+
+def create_task_search_triggers(conn) -> None:
+    for trigger in task_search_triggers:
+        conn.exec_driver_sql(trigger)
+
+
+def uses_compact_storage(task_columns: list) -> bool:
+    """Whether the task table (its `PRAGMA table_info` rows), or the
+    archive table, was created with the compact storage format.
+    """
+    return any(
+        name == "id" and type.upper() == "BLOB" for _, name, type, *_ in task_columns
+    )
+
+
+def to_compact_value(value, column):
+    """Convert a value stored in the default format to the compact one."""
+    if isinstance(value, str):
+        if isinstance(column.type, CompactUUID):
+            return UUID(value).bytes
+        if isinstance(column.type, CompactDateTime):
+            return (datetime.fromisoformat(value) - epoch) // one_microsecond
+    return value
+
+
+def migrate_to_compact(engine, batch_size: int = rewrite_batch_size) -> None:
+    """Rewrite the task and archive tables from the default storage format
+    (hex text ids, ISO text datetimes) to the compact one
+    (16 bytes ids, integer microseconds datetimes), see rewrite_task_table().
+    A table already in the compact format is skipped, so running it again
+    finishes an interrupted migration.
+    The engine's storage format is switched to compact, it must not have
+    run any task query yet (type processors are cached per engine).
+    """
+    engine.dialect.compact_storage = True
+    for table in (Task.__table__, ArchivedTask.__table__):
+        with engine.connect() as conn:
+            columns = conn.exec_driver_sql(f"PRAGMA table_info({table.name})").all()
+        if columns and not uses_compact_storage(columns):
+            rewrite_task_table(engine, to_compact_value, batch_size, table=table)
+    # give the space of the old, bigger rows back to the file system
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").exec_driver_sql("VACUUM")
+
+
+@migration(1)
+def create_task_table(conn):
+    """Task table with the next-task queue and task list indexes.
+    DBs from before versioning (user_version 0) have the table but
+    not the indexes.
+    """
+    Task.__table__.create(conn, checkfirst=True)
+    columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(task)")}
+    for index in Task.__table__.indexes:
+        # the ones on columns added by later migrations are created by them
+        if {column.name for column in index.columns} <= columns:
+            index.create(conn, checkfirst=True)
+
+
+@migration(2)
+def create_task_search(conn):
+    """task_fts, the FTS5 full-text index of the task titles (see
+    models.task_fts), its sync triggers, and the index of the existing tasks.
+    """
+    conn.exec_driver_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS task_fts USING fts5("
+        "title, content='task', content_rowid='rowid')"
+    )
+    create_task_search_triggers(conn)
+    conn.exec_driver_sql("INSERT INTO task_fts(task_fts) VALUES ('rebuild')")
+
+
+@migration(3)
+def add_task_archive(conn):
+    """task.completed_at (set to the last activity of the tasks already
+    completed) and the task_archive table.
+    """
+    columns = [row[1] for row in conn.exec_driver_sql("PRAGMA table_info(task)")]
+    if "completed_at" not in columns:
+        column_type = Task.__table__.c.completed_at.type.compile(dialect=conn.dialect)
+        conn.exec_driver_sql(f"ALTER TABLE task ADD COLUMN completed_at {column_type}")
+        conn.exec_driver_sql(
+            "UPDATE task SET completed_at = last_deferred WHERE is_completed"
+        )
+    ArchivedTask.__table__.create(conn, checkfirst=True)
+    for index in ArchivedTask.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+@migration(4)
+def add_task_lists(conn):
+    """task.list_id and task_archive.list_id (the existing tasks go to the
+    default list), and the indexes starting with it.
+    """
+    for table in (Task.__table__, ArchivedTask.__table__):
+        columns = [
+            row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table.name})")
+        ]
+        if "list_id" not in columns:
+            column_type = table.c.list_id.type.compile(dialect=conn.dialect)
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table.name} ADD COLUMN list_id {column_type} "
+                f"NOT NULL DEFAULT '{default_list_id}'"
+            )
+        for index in table.indexes:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+            index.create(conn)
+
+
+# version of the schema created by this code
+schema_version = latest_version()
@@ -1,15 +1,179 @@
 from sqlmodel import SQLModel, Field
+from sqlalchemy import BigInteger, CHAR, DateTime, Index, LargeBinary, column, table
+from sqlalchemy.types import TypeDecorator
 from uuid import UUID, uuid4
-from datetime import datetime
+from datetime import datetime, timedelta
+
+# list of the tasks added without naming one, see TaskAPI.for_list()
+default_list_id = "default"
+
+epoch = datetime(1970, 1, 1)
+one_microsecond = timedelta(microseconds=1)
+
+
+def is_compact(dialect) -> bool:
+    """Whether the engine owning this dialect uses the compact storage format.
+    Set by db.get_engine, which picks the format per DB file.
+    """
+    return getattr(dialect, "compact_storage", False)
+
+
+class CompactUUID(TypeDecorator):
+    """UUID stored as 32 hex chars (same as SQLModel's default),
+    or as 16 raw bytes on a compact DB.
+    """
+
+    impl = CHAR(32)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if is_compact(dialect):
+            return dialect.type_descriptor(LargeBinary(16))
+        return dialect.type_descriptor(CHAR(32))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, UUID):
+            value = UUID(value)
+        return value.bytes if is_compact(dialect) else value.hex
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            return UUID(bytes=value)
+        return UUID(hex=value)
+
+
+class CompactDateTime(TypeDecorator):
+    """datetime stored as ISO text (same as SQLModel's default),
+    or as an integer count of microseconds since 1970-01-01 on a compact DB.
+    Datetimes are naive local time, they're counted as is (no timezone
+    conversion) so the value round-trips exactly.
+    """
+
+    impl = DateTime
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if is_compact(dialect):
+            return dialect.type_descriptor(BigInteger())
+        return dialect.type_descriptor(DateTime())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not is_compact(dialect):
+            return value
+        return (value - epoch) // one_microsecond
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, int):
+            return epoch + value * one_microsecond
+        return value
 
 
 class Task(SQLModel, table=True):
-    id: UUID | None = Field(default_factory=uuid4, primary_key=True)
+    # the "next task" queue of a list is
+    # `list_id = ? AND is_completed = 0 ORDER BY last_deferred`,
+    # this index lets SQLite walk it in order instead of scanning and sorting.
+    # the other two serve the paginated task list (all / by status).
+    # every query is scoped to a list, so they all start with list_id: the
+    # cost of a list's queries doesn't depend on the size of the other lists
+    __table_args__ = (
+        Index("ix_task_queue", "list_id", "is_completed", "last_deferred"),
+        Index("ix_task_created", "list_id", "created_at", "id"),
+        Index("ix_task_status_created", "list_id", "is_completed", "created_at", "id"),
+    )
+
+    id: UUID | None = Field(
+        default_factory=uuid4, primary_key=True, sa_type=CompactUUID
+    )
     title: str
     is_completed: bool = False
     created_at: datetime = Field(
         default_factory=datetime.now,
+        sa_type=CompactDateTime,
     )
     last_deferred: datetime = Field(
         default_factory=datetime.now,
+        sa_type=CompactDateTime,
     )
+    # when the task was last completed, None while it's not.
+    # completed tasks are archived some time after it (see ArchivedTask)
+    completed_at: datetime | None = Field(default=None, sa_type=CompactDateTime)
+    list_id: str = Field(
+        default=default_list_id,
+        sa_column_kwargs={"server_default": default_list_id},
+    )
+
+
+class ArchivedTask(SQLModel, table=True):
+    """A completed task moved out of the task table, so the table (and its
+    queries) only grows with the open and recently completed tasks.
+    See TaskAPI.archive_completed() and TaskAPI.restore_task().
+    """
+
+    __tablename__ = "task_archive"
+    # archived history is listed by completion, newest first
+    __table_args__ = (
+        Index("ix_task_archive_completed", "list_id", "completed_at", "id"),
+    )
+
+    id: UUID = Field(primary_key=True, sa_type=CompactUUID)
+    title: str
+    is_completed: bool = True
+    created_at: datetime = Field(sa_type=CompactDateTime)
+    last_deferred: datetime = Field(sa_type=CompactDateTime)
+    completed_at: datetime | None = Field(default=None, sa_type=CompactDateTime)
+    list_id: str = Field(
+        default=default_list_id,
+        sa_column_kwargs={"server_default": default_list_id},
+    )
+
+
+# columns copied between the task and task_archive tables, same names in both
+archived_columns = (
+    "id",
+    "title",
+    "is_completed",
+    "created_at",
+    "last_deferred",
+    "completed_at",
+    "list_id",
+)
+
+
+class TaskRow:
+    """Lightweight copy of a task row, returned by the fast list methods
+    of TaskAPI instead of a full Task model instance. It isn't tracked by
+    any session, changing it doesn't change the DB.
+    """
+
+    __slots__ = ("id", "title", "is_completed", "created_at", "last_deferred")
+
+    def __init__(self, id, title, is_completed, created_at, last_deferred):
+        self.id = id
+        self.title = title
+        self.is_completed = is_completed
+        self.created_at = created_at
+        self.last_deferred = last_deferred
+
+    def __repr__(self):
+        return f"TaskRow(id={self.id!r}, title={self.title!r})"
+
+
+# FTS5 full-text index of the task titles, an external content table reading
+# its content from the task table (same rowids), kept in sync by triggers.
+# not a SQLModel table: it's created by the migrations (see migrations.py)
+task_fts = table("task_fts", column("rowid"), column("title"), column("rank"))
+
+
+# columns selected for a TaskRow, in its __init__ order: table columns, not
+# ORM attributes, so the TaskRow queries are plain Core ones
+task_row_columns = (
+    Task.__table__.c.id,
+    Task.__table__.c.title,
+    Task.__table__.c.is_completed,
+    Task.__table__.c.created_at,
+    Task.__table__.c.last_deferred,
+)
@@ -0,0 +1,147 @@
+"""Headless HTTP/JSON server for the tasks of one DB.
+
+Lets devices and scripts on the LAN share a single task queue:
+
+    python server.py --host 0.0.0.0 --port 8000
+
+Calls go through a ConcurrentTaskAPI: writes are applied one at a time by
+its writer thread, reads run on its reader threads, each with its own
+session; the DB uses WAL (the "balanced" profile by default) so they don't
+wait on the writer. The next task is served from the in-memory queue.
+
+Run a single server process per DB file, see `python bench.py --http URL`
+to load test it.
+"""
+
+import argparse
+import sys
+from asyncio import wrap_future
+from contextlib import asynccontextmanager
+from uuid import UUID
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+from sqlmodel import SQLModel
+
+from api import TaskException, TaskNotFound
+from concurrent_api import ConcurrentTaskAPI
+from db import sqlite_url
+from models import Task
+
+default_host = "127.0.0.1"
+default_port = 8000
+
+
+class TaskTitle(SQLModel):
+    title: str
+
+
+def task_row_dict(row) -> dict:
+    return {
+        "id": row.id,
+        "title": row.title,
+        "is_completed": row.is_completed,
+        "created_at": row.created_at,
+        "last_deferred": row.last_deferred,
+    }
+
+
+def create_app(db_url: str = sqlite_url, profile: str = "balanced") -> FastAPI:
+    """FastAPI app serving the tasks of the DB at db_url."""
+    api = None
+
+    @asynccontextmanager
+    async def lifespan(app):
+        nonlocal api
+        api = ConcurrentTaskAPI(db_url, cache_queue=True, profile=profile)
+        try:
+            yield
+        finally:
+            api.close()
+
+    app = FastAPI(title="Kute Task", lifespan=lifespan)
+
+    @app.exception_handler(TaskNotFound)
+    async def task_not_found(request: Request, e: TaskNotFound):
+        return JSONResponse(status_code=404, content={"detail": str(e)})
+
+    @app.exception_handler(TaskException)
+    async def invalid_request(request: Request, e: TaskException):
+        return JSONResponse(status_code=422, content={"detail": str(e)})
+
+    @app.get("/tasks/next")
+    async def next_task() -> Task:
+        # in memory, no DB access
+        task = api.sync.get_next_task()
+        if task is None:
+            raise TaskNotFound("[Error] no task left to do")
+        return task
+
+    @app.get("/tasks")
+    async def list_tasks(
+        status: str = "all", after: UUID | None = None, limit: int = 50
+    ) -> list[dict]:
+        after_task = None if after is None else await wrap_future(api.get_task(after))
+        rows = await wrap_future(api.list_task_rows(after_task, limit, status))
+        return [task_row_dict(row) for row in rows]
+
+    @app.get("/tasks/search")
+    async def search_tasks(q: str, status: str = "all", limit: int = 50) -> list[dict]:
+        rows = await wrap_future(api.search_tasks(q, limit, status))
+        return [task_row_dict(row) for row in rows]
+
+    @app.get("/tasks/{id}")
+    async def get_task(id: str) -> Task:
+        return await wrap_future(api.get_task(id))
+
+    @app.post("/tasks", status_code=201)
+    async def add_task(body: TaskTitle) -> Task:
+        task = Task(title=body.title)
+        await wrap_future(api.add_task(task))
+        return task
+
+    @app.patch("/tasks/{id}")
+    async def update_task_title(id: str, body: TaskTitle) -> Task:
+        return await wrap_future(api.update_task_title(id, body.title))
+
+    @app.post("/tasks/{id}/defer", status_code=204)
+    async def defer_task(id: str) -> Response:
+        await wrap_future(api.defer_task(id))
+        return Response(status_code=204)
+
+    @app.post("/tasks/{id}/complete")
+    async def complete_task(id: str) -> Task:
+        await wrap_future(api.set_completed_many([id], True))
+        return await wrap_future(api.get_task(id))
+
+    @app.post("/tasks/{id}/reopen")
+    async def reopen_task(id: str) -> Task:
+        await wrap_future(api.set_completed_many([id], False))
+        return await wrap_future(api.get_task(id))
+
+    @app.delete("/tasks/{id}", status_code=204)
+    async def delete_task(id: str) -> Response:
+        await wrap_future(api.delete_task(id))
+        return Response(status_code=204)
+
+    @app.get("/stats")
+    async def task_stats() -> dict:
+        return (await wrap_future(api.task_stats()))._asdict()
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=default_host)
+    parser.add_argument("--port", type=int, default=default_port)
+    parser.add_argument("--db-url", default=sqlite_url)
+    parser.add_argument("--profile", default="balanced")
+    args = parser.parse_args(argv)
+    # a single process: it owns the DB writes and the in-memory queue
+    uvicorn.run(create_app(args.db_url, args.profile), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+from threading import Condition, local
+
+from sqlmodel import Session
+
+
+class SessionManager:
+    """Reusable Sessions of a TaskAPI: one per thread, instead of a new
+    Session per call.
+
+    A session only holds a pooled connection during a call (or a unit of
+    work): it's closed at the end of each, which ends the transaction and
+    hands the connection back to the pool, so any number of threads can
+    make calls with a pool of a few connections. Closing also expunges the
+    objects, so the identity map never serves stale ones. Sessions don't
+    expire objects on commit, the ones returned by a call stay usable
+    after it.
+
+    unit_of_work() groups the calls made in its block into one transaction.
+    exclusive() waits for the calls in progress in every thread and holds
+    off new ones, e.g. while the DB file is replaced.
+    Work that must only happen once a change is committed (queue cache
+    updates, events) is registered with after_commit(), work undoing an
+    in-memory change if it's rolled back with after_rollback().
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._local = local()
+        # calls in progress in every thread, and in this one (nested ones
+        # count once), see exclusive()
+        self._calls = 0
+        self._depth = local()
+        self._idle = Condition()
+        self._exclusive = False
+
+    def _thread_session(self) -> Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = Session(self._engine, expire_on_commit=False)
+            self._local.session = session
+        return session
+
+    @contextmanager
+    def _call(self):
+        depth = getattr(self._depth, "value", 0)
+        if not depth:
+            with self._idle:
+                while self._exclusive:
+                    self._idle.wait()
+                self._calls += 1
+        self._depth.value = depth + 1
+        try:
+            yield
+        finally:
+            self._depth.value = depth
+            if not depth:
+                with self._idle:
+                    self._calls -= 1
+                    self._idle.notify_all()
+
+    def in_unit_of_work(self) -> bool:
+        return getattr(self._local, "after_commit", None) is not None
+
+    @contextmanager
+    def session(self, write: bool = False):
+        """The thread's session for a single call, committed at the end if
+        write (by the unit of work if one is open), rolled back on error.
+        """
+        with self._call():
+            session = self._thread_session()
+            if self.in_unit_of_work():
+                yield session
+                return
+            try:
+                yield session
+                if write:
+                    session.commit()
+            except BaseException:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+    def after_commit(self, callback, *args) -> None:
+        """Call callback(*args) now, or once the open unit of work commits
+        (never if it's rolled back).
+        """
+        pending = getattr(self._local, "after_commit", None)
+        if pending is None:
+            callback(*args)
+        else:
+            pending.append((callback, args))
+
+    def after_rollback(self, callback, *args) -> None:
+        """Call callback(*args) if the open unit of work is rolled back,
+        nothing if there's none (a single call's changes are committed).
+        """
+        pending = getattr(self._local, "after_rollback", None)
+        if pending is not None:
+            pending.append((callback, args))
+
+    @contextmanager
+    def unit_of_work(self):
+        """Run the calls made in the block, in this thread, in one
+        transaction: committed at the end of the block, rolled back if it
+        raises. A nested unit of work joins the outer one.
+        """
+        if self.in_unit_of_work():
+            yield
+            return
+        with self._call():
+            session = self._thread_session()
+            pending = self._local.after_commit = []
+            undo = self._local.after_rollback = []
+            committed = False
+            try:
+                yield
+                session.commit()
+                committed = True
+            except BaseException:
+                session.rollback()
+                raise
+            finally:
+                self._local.after_commit = None
+                self._local.after_rollback = None
+                session.close()
+                if not committed:
+                    for callback, args in undo:
+                        callback(*args)
+        for callback, args in pending:
+            callback(*args)
+
+    @contextmanager
+    def exclusive(self):
+        """Wait for the calls in progress in every thread to end and hold
+        off new ones until the end of the block: no session holds a
+        connection during it. Threads get a new session after it.
+        """
+        if getattr(self._depth, "value", 0):
+            raise RuntimeError("exclusive() can't be used during a call")
+        with self._idle:
+            while self._exclusive:
+                self._idle.wait()
+            self._exclusive = True
+            while self._calls:
+                self._idle.wait()
+        try:
+            self._local = local()
+            yield
+        finally:
+            with self._idle:
+                self._exclusive = False
+                self._idle.notify_all()
+
+    def close(self) -> None:
+        """Wait for the calls in progress, whose sessions hold the only
+        checked out connections, to end. Threads get a new session on
+        their next call.
+        """
+        with self.exclusive():
+            pass
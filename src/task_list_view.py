@@ -1,9 +1,32 @@
+import asyncio
+import logging
+from typing import NamedTuple
+
 import flet as ft
-from api import TaskAPI
-from db import sqlite_url
+from events import TaskEventKind
 from models import Task
 
-api = TaskAPI(sqlite_url)
+logger = logging.getLogger("kute_task.list_view")
+
+# number of tasks loaded per page in the task list view
+page_size = 50
+# how close (in pixels) to the end of the list scrolling loads the next page
+load_more_threshold = 200
+# seconds the search box waits for typing to pause before searching
+search_delay = 0.3
+
+
+class ListChanges(NamedTuple):
+    """TaskControls touched by a refresh of the task list (see reconcile())."""
+
+    added: int
+    updated: int
+    moved: int
+    removed: int
+
+    @property
+    def touched(self) -> int:
+        return self.added + self.updated + self.moved + self.removed
 
 
 class TaskControl(ft.Column):
@@ -41,7 +64,7 @@ class TaskControl(ft.Column):
                         ft.IconButton(
                             ft.Icons.DELETE_OUTLINE,
                             tooltip="Delete Task",
-                            on_click=lambda e: self.delete_clicked(task.id),
+                            on_click=self.delete_clicked,
                         ),
                     ],
                 ),
@@ -65,42 +88,75 @@ class TaskControl(ft.Column):
         )
         self.controls = [self.display_view, self.edit_view]
 
+    def set_task(self, task):
+        """Show the new state of the task."""
+        self.task = task
+        self.display_task.value = task.is_completed
+        self.display_task.label = task.title
+
     def edit_clicked(self, e):
         self.edit_name.value = self.display_task.label
         self.display_view.visible = False
         self.edit_view.visible = True
         self.update()
 
-    def save_clicked(self, e):
+    async def save_clicked(self, e):
         self.display_task.label = self.edit_name.value
-        self.task_title_update(self.task, self.display_task.label)
+        await self.task_title_update(self.task, self.display_task.label)
         self.display_view.visible = True
         self.edit_view.visible = False
 
-    def status_changed(self, e):
+    async def status_changed(self, e):
         self.completed = self.display_task.value
-        self.task_status_change(self.task)
+        await self.task_status_change(self.task)
 
-    def delete_clicked(self, e):
-        self.task_delete(self, e)
+    async def delete_clicked(self, e):
+        await self.task_delete(self, self.task.id)
 
 
 class ListTasksView(ft.Column):
     """a view to display a list of task (each task represented by a TaskControl)
-    with a tab for filtering and a textbox for adding new tasks"""
+    with a tab for filtering and a textbox for adding new tasks.
+    api is an AsyncTaskAPI, writes are awaited from async event handlers.
+    Tasks are loaded a page at a time as TaskRows (see TaskAPI.list_task_rows),
+    the next page is loaded when scrolling near the end of the list.
+    Changes, made here or anywhere else in the app, are applied from the
+    API's change events (see task_changed()) to the affected control only."""
 
-    def __init__(self, get_task_list_from_db):
+    def __init__(self, api):
         super().__init__()
+        self.api = api
+        # last task of the last loaded page, the cursor for the next page
+        self.last_loaded_task = None
+        self.all_loaded = False
+        self.loading = False
+        # TaskControl of every loaded task, by task id
+        self.task_controls = {}
+        # controls touched by the last refresh, see reconcile()
+        self.last_changes = None
+        # whether build() loaded the counters and first page, which are then
+        # kept up to date by task_changed() (build() runs on every mount)
+        self.loaded = False
+        self.total_count = 0
+        self.active_count = 0
+        self.api.subscribe(self.task_changed)
         self.new_task = ft.TextField(
             hint_text="What needs to be done?",
             on_submit=self.add_clicked,
             expand=True,
             max_length=30,
         )
+        # titles searched for, the list shows the search results (unpaged)
+        # instead of the pages of tasks while it's not empty
+        self.search_text = ""
+        self.search = ft.TextField(
+            hint_text="Search tasks",
+            prefix_icon=ft.Icons.SEARCH,
+            on_change=self.search_changed,
+            dense=True,
+        )
         self.tasks = ft.ListView(spacing=0, auto_scroll=False, expand=True)
 
-        self.get_task_list_from_db = get_task_list_from_db
-
         self.filter = ft.Tabs(
             scrollable=False,
             selected_index=0,
@@ -126,12 +182,15 @@ class ListTasksView(ft.Column):
                     ),
                 ],
             ),
+            self.search,
             ft.Container(
                 expand=True,
                 content=ft.Column(
                     spacing=25,
                     expand=True,
                     scroll=ft.ScrollMode.AUTO,
+                    on_scroll=self.list_scrolled,
+                    on_scroll_interval=100,
                     controls=[
                         self.filter,
                         self.tasks,
@@ -151,71 +210,225 @@ class ListTasksView(ft.Column):
             ),
         ]
 
-    def add_clicked(self, e):
+    async def add_clicked(self, e):
         if self.new_task.value:
-            task = Task(title=self.new_task.value)
-            added_task_id = api.add_task(task)
-            added_task = api.get_task(str(added_task_id))
+            await self.api.add_task(Task(title=self.new_task.value))
             self.page.open(ft.SnackBar(ft.Text("New task added.")))
-
-            task_control = TaskControl(
-                added_task,
-                self.task_status_change,
-                self.task_title_update,
-                self.task_delete,
-            )
-            self.tasks.controls.append(task_control)
             self.new_task.value = ""
             self.new_task.focus()
             self.update()
 
-    def task_status_change(self, task):
-        updated_task = api.toggle_complete(str(task.id))
-        task.is_completed = updated_task.is_completed
+    async def task_status_change(self, task):
+        await self.api.toggle_complete(task.id)
         self.update()
 
-    def task_title_update(self, task, title):
-        updated_task = api.update_task_title(str(task.id), title)
+    async def task_title_update(self, task, title):
+        await self.api.update_task_title(task.id, title)
         self.page.open(ft.SnackBar(ft.Text("Task updated.")))
-        task.title = updated_task.title
         self.update()
 
-    def task_delete(self, task_item, task_id):
-        api.delete_task(str(task_id))
+    async def task_delete(self, task_item, task_id):
+        await self.api.delete_task(task_id)
         self.page.open(ft.SnackBar(ft.Text("Task deleted.")))
-        self.tasks.controls.remove(task_item)
         self.update()
 
-    def tabs_changed(self, e):
+    def task_changed(self, event):
+        """Apply a TaskEvent to the counters and the affected control.
+        The control tree is sent to the page by the next update().
+        """
+        if event.kind == TaskEventKind.ALL_DELETED:
+            self.total_count = self.active_count = 0
+            self.reset_tasks()
+            self.all_loaded = True
+            return
+        if event.kind in (TaskEventKind.IMPORTED, TaskEventKind.REPLACED):
+            # reload the counters and the list, the next build() does if the
+            # view isn't shown
+            if self.page is None:
+                self.loaded = False
+            else:
+                self.page.run_task(self.reload)
+            return
+        task = event.task
+        control = self.task_controls.get(event.task_id)
+        if event.kind in (TaskEventKind.ADDED, TaskEventKind.RESTORED):
+            self.total_count += 1
+            self.active_count += not task.is_completed
+            # newest task goes last, if more pages are still to be loaded
+            # it'll show up with them
+            if self.all_loaded and not self.search_text and control is None:
+                self.append_task(task)
+        elif event.kind in (TaskEventKind.DELETED, TaskEventKind.ARCHIVED):
+            self.total_count -= 1
+            self.active_count -= not task.is_completed
+            if control is not None:
+                self.tasks.controls.remove(control)
+                del self.task_controls[event.task_id]
+        else:
+            if event.kind == TaskEventKind.COMPLETED:
+                self.active_count -= 1
+            elif event.kind == TaskEventKind.REOPENED:
+                self.active_count += 1
+            if control is not None:
+                control.set_task(task)
+
+    async def tabs_changed(self, e):
+        await self.refresh()
+
+    async def search_changed(self, e):
+        """Search once typing pauses for search_delay: the handlers of the
+        keystrokes typed meanwhile see the text changed and drop out.
+        """
+        text = self.search.value.strip()
+        await asyncio.sleep(search_delay)
+        if text != self.search.value.strip() or text == self.search_text:
+            return
+        self.search_text = text
+        await self.refresh()
+
+    async def list_scrolled(self, e):
+        if e.pixels >= e.max_scroll_extent - load_more_threshold:
+            await self.load_next_page()
+
+    async def clear_clicked(self, e):
+        deleted = await self.api.clear_completed()
+        if deleted:
+            self.page.open(ft.SnackBar(ft.Text(f"{deleted} completed task(s) deleted.")))
         self.update()
 
-    def clear_clicked(self, e):
-        for t in self.tasks.controls[:]:
-            if t.task.is_completed:
-                self.task_delete(t, t.task.id)
+    def selected_status(self):
+        return self.filter.tabs[self.filter.selected_index].text
 
-    def build(self):
+    def new_task_control(self, task):
+        return TaskControl(
+            task,
+            self.task_status_change,
+            self.task_title_update,
+            self.task_delete,
+        )
+
+    def append_task(self, task):
+        control = self.new_task_control(task)
+        self.task_controls[task.id] = control
+        self.tasks.controls.append(control)
+
+    def reset_tasks(self):
         self.tasks.controls.clear()
-        if not len(self.tasks.controls):
-            for task in self.get_task_list_from_db():
-                task_item = TaskControl(
-                    task,
-                    self.task_status_change,
-                    self.task_title_update,
-                    self.task_delete,
-                )
-                self.tasks.controls.append(task_item)
+        self.task_controls.clear()
+        self.last_loaded_task = None
+        self.all_loaded = False
+
+    def reconcile(self, tasks) -> ListChanges:
+        """Make the list show tasks, in order, keyed by task id: the
+        TaskControl of a task already shown is reused (and moved or updated
+        if needed), only new tasks get a control and only tasks no longer
+        shown lose theirs, so Flet only sends the controls that changed.
+        """
+        old_controls = self.task_controls
+        new_controls = {}
+        controls = []
+        added = updated = 0
+        for task in tasks:
+            control = old_controls.get(task.id)
+            if control is None:
+                control = self.new_task_control(task)
+                added += 1
+            else:
+                shown = control.task
+                if shown.title != task.title or shown.is_completed != task.is_completed:
+                    updated += 1
+                control.set_task(task)
+            new_controls[task.id] = control
+            controls.append(control)
+
+        # order of the reused controls, before and after
+        kept_before = [c for c in self.tasks.controls if c.task.id in new_controls]
+        kept_after = [c for c in controls if c.task.id in old_controls]
+        moved = sum(a is not b for a, b in zip(kept_before, kept_after))
+        removed = len(old_controls) - len(kept_before)
+
+        self.tasks.controls[:] = controls
+        self.task_controls = new_controls
+        return ListChanges(added, updated, moved, removed)
+
+    def show_first_page(self, tasks):
+        """Show tasks as the only loaded page, reconciling the list with it."""
+        self.last_changes = self.reconcile(tasks)
+        logger.debug("task list refreshed: %s", self.last_changes)
+        self.last_loaded_task = None
+        self.page_loaded(tasks)
+
+    def append_page(self, tasks):
+        for task in tasks:
+            self.append_task(task)
+        self.page_loaded(tasks)
+
+    def page_loaded(self, tasks):
+        if tasks:
+            self.last_loaded_task = tasks[-1]
+        self.all_loaded = len(tasks) < page_size
+
+    async def refresh(self):
+        """Reload the first page of the selected tab, or the search results,
+        and reconcile the list with it.
+        """
+        status = self.selected_status()
+        if self.search_text:
+            text = self.search_text
+            tasks = await self.api.search_tasks(text, status=status)
+            if text != self.search_text:
+                # a newer search is running
+                return
+            self.show_first_page(tasks)
+            # search results are never paged
+            self.all_loaded = True
+        else:
+            tasks = await self.api.list_task_rows(limit=page_size, status=status)
+            self.show_first_page(tasks)
+        self.update()
+
+    async def reload(self):
+        stats = await self.api.task_stats()
+        self.total_count = stats.total
+        self.active_count = stats.active
+        await self.refresh()
+
+    async def load_next_page(self):
+        if self.loading or self.all_loaded:
+            return
+        self.loading = True
+        try:
+            tasks = await self.api.list_task_rows(
+                after=self.last_loaded_task,
+                limit=page_size,
+                status=self.selected_status(),
+            )
+            self.append_page(tasks)
+        finally:
+            self.loading = False
+        self.update()
+
+    def build(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        stats = self.api.sync.task_stats()
+        self.total_count = stats.total
+        self.active_count = stats.active
+        self.show_first_page(
+            self.api.sync.list_task_rows(
+                limit=page_size, status=self.selected_status()
+            )
+        )
 
     def before_update(self):
-        self.task_list_from_db = self.get_task_list_from_db()
-        status = self.filter.tabs[self.filter.selected_index].text
-        count = 0
+        status = self.selected_status()
         for t in self.tasks.controls:
             t.visible = (
                 status == "all"
                 or (status == "active" and t.task.is_completed == False)
                 or (status == "completed" and t.task.is_completed)
             )
-            if not t.task.is_completed:
-                count += 1
-        self.items_left.value = f"{count} task(s) left of {api.count_tasks()} total"
+        self.items_left.value = (
+            f"{self.active_count} task(s) left of {self.total_count} total"
+        )
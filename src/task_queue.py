@@ -0,0 +1,91 @@
+import heapq
+from itertools import count
+from threading import RLock
+from typing import Callable
+from uuid import UUID
+
+from models import Task
+
+
+class TaskQueue:
+    """In-memory queue of incomplete tasks ordered by last_deferred.
+
+    Backed by a heap of [last_deferred, seq, id] entries. Entries for tasks
+    that got deferred, completed or deleted are marked removed (id set to None)
+    and dropped lazily when they reach the top of the heap.
+
+    Guarded by a lock since it's read from the UI thread while AsyncTaskAPI
+    applies writes from its worker thread.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._tasks = {}
+        self._seq = count()
+        self._lock = RLock()
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def __contains__(self, id: UUID) -> bool:
+        return id in self._tasks
+
+    def load(self, tasks: list[Task]) -> None:
+        """Replace the queue content with the given incomplete tasks."""
+        with self._lock:
+            self.clear()
+            for task in tasks:
+                entry = [task.last_deferred, next(self._seq), task.id]
+                self._entries[task.id] = entry
+                self._tasks[task.id] = task
+                self._heap.append(entry)
+            heapq.heapify(self._heap)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._heap.clear()
+            self._entries.clear()
+            self._tasks.clear()
+
+    def push(self, task: Task) -> None:
+        """Add a task to the queue, or move it if it's already queued."""
+        with self._lock:
+            self.remove(task.id)
+            entry = [task.last_deferred, next(self._seq), task.id]
+            self._entries[task.id] = entry
+            self._tasks[task.id] = task
+            heapq.heappush(self._heap, entry)
+
+    def remove(self, id: UUID) -> None:
+        """Remove a task from the queue if it's queued."""
+        with self._lock:
+            entry = self._entries.pop(id, None)
+            if entry is not None:
+                entry[-1] = None
+                del self._tasks[id]
+
+    def update(self, id: UUID, change: Callable[[Task], Task]) -> Task | None:
+        """Replace a queued task with change(task) (moving it if needed) and
+        return the new one, None if it isn't queued. Atomic: the task can't
+        be removed in between.
+        """
+        with self._lock:
+            task = self._tasks.get(id)
+            if task is None:
+                return None
+            task = change(task)
+            self.push(task)
+            return task
+
+    def get(self, id: UUID) -> Task | None:
+        return self._tasks.get(id)
+
+    def peek(self) -> Task | None:
+        """Return the next task (least recently deferred) without removing it."""
+        with self._lock:
+            while self._heap and self._heap[0][-1] is None:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return None
+            return self._tasks[self._heap[0][-1]]
@@ -1,21 +1,52 @@
+import asyncio
+import bench
+import io
+import migrations
+import json
 import pytest
+import sqlite3
+import threading
+import time
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from datetime import datetime, timedelta, timezone
 from uuid import uuid4
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
 
-from api import TaskAPI, TaskNotFound, InvalidTaskID, MissingTitle, InvalidTitle
+from async_api import AsyncTaskAPI
+from backups import BackupException, CorruptBackup, list_snapshots
+from concurrent_api import ConcurrentTaskAPI, WriteQueueFull, call_with_retry
+from api import (
+    TaskAPI,
+    TaskNotFound,
+    InvalidTaskID,
+    MissingTitle,
+    InvalidTitle,
+    InvalidStatus,
+    InvalidFormat,
+    InvalidImport,
+    InvalidListID,
+)
+from db import profiles, schema_version, InvalidDBProfile
+from events import TaskEventKind
 from models import Task
 
 test_db_file_name = "tasks_test_db.sqlite3"
 
 
-@pytest.fixture(scope="module")
-def task_api():
+@pytest.fixture(
+    scope="module",
+    params=[{}, {"cache_queue": True}, {"compact": True}, {"write_behind": True}],
+    ids=["db", "cached_queue", "compact", "write_behind"],
+)
+def task_api(request):
     with TemporaryDirectory() as tmp_dir:
         base_dir = Path(tmp_dir)
         db_path = base_dir / test_db_file_name
         sqlite_url = f"sqlite:///{db_path}"
-        api = TaskAPI(sqlite_url)
+        api = TaskAPI(sqlite_url, **request.param)
         yield api
 
 
@@ -245,4 +276,1575 @@ def test_toggle_non_existent_task(task_api):
     """Test toggling a non-existent task"""
     id = str(uuid4())
     with pytest.raises(TaskNotFound):
-        assert task_api.toggle_complete(id).id == id
\ No newline at end of file
+        assert task_api.toggle_complete(id).id == id
+
+
+def test_next_task_query_uses_queue_index(task_api):
+    """get_next_task() should walk the ix_task_queue index
+    instead of scanning the whole task table and sorting it.
+    """
+    with task_api._engine.connect() as conn:
+        plan = conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT * FROM task "
+            "WHERE list_id = 'default' AND is_completed = 0 "
+            "ORDER BY last_deferred LIMIT 1"
+        ).all()
+    details = " ".join(row[-1] for row in plan)
+    assert "ix_task_queue" in details and "TEMP B-TREE" not in details
+
+
+def test_get_engine_adds_index_to_existing_db():
+    """A DB created before the queue index existed (user_version 0)
+    should get the index added when it's opened.
+    """
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / test_db_file_name
+        sqlite_url = f"sqlite:///{db_path}"
+        TaskAPI(sqlite_url)
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("DROP INDEX ix_task_queue")
+            conn.execute("PRAGMA user_version = 0")
+        TaskAPI(sqlite_url)
+        with sqlite3.connect(db_path) as conn:
+            indexes = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            ).fetchall()
+        assert ("ix_task_queue",) in indexes
+
+
+def test_cached_queue_matches_db():
+    """The in-memory queue should always give the same next task
+    as querying the DB, through adds, defers, toggles and deletes.
+    """
+    with TemporaryDirectory() as tmp_dir:
+        sqlite_url = f"sqlite:///{Path(tmp_dir) / test_db_file_name}"
+        db_api = TaskAPI(sqlite_url)
+        cached_api = TaskAPI(sqlite_url, cache_queue=True)
+
+        def same_next_task():
+            db_next = db_api.get_next_task()
+            cached_next = cached_api.get_next_task()
+            if db_next is None:
+                return cached_next is None
+            return cached_next.id == db_next.id and cached_next.title == db_next.title
+
+        assert cached_api.get_next_task() is None
+        ids = [str(cached_api.add_task(Task(title=f"Task {i}"))) for i in range(4)]
+        assert same_next_task()
+        cached_api.defer_task(ids[0])
+        assert same_next_task()
+        cached_api.update_task_title(ids[1], "renamed")
+        assert same_next_task()
+        cached_api.toggle_complete(ids[1])
+        assert same_next_task()
+        cached_api.delete_task(ids[2])
+        assert same_next_task()
+        cached_api.toggle_complete(ids[1])
+        assert same_next_task()
+        cached_api.defer_tasks([ids[1], ids[3]])
+        assert same_next_task()
+        cached_api.set_completed_many(ids)
+        assert same_next_task()
+        cached_api.set_completed_many([ids[3]], completed=False)
+        assert same_next_task()
+        cached_api.delete_tasks([ids[3]])
+        assert same_next_task()
+        cached_api.delete_all_tasks()
+        assert same_next_task()
+
+
+def test_cached_queue_loads_existing_tasks():
+    with TemporaryDirectory() as tmp_dir:
+        sqlite_url = f"sqlite:///{Path(tmp_dir) / test_db_file_name}"
+        db_api = TaskAPI(sqlite_url)
+        first_id = db_api.add_task(Task(title="first"))
+        db_api.add_task(Task(title="second"))
+        cached_api = TaskAPI(sqlite_url, cache_queue=True)
+        assert cached_api.get_next_task().id == first_id
+
+
+def test_add_tasks(task_api):
+    init_count = task_api.count_tasks()
+    tasks = [Task(title=f"bulk task {i}") for i in range(5)]
+    ids = task_api.add_tasks(tasks)
+    assert ids == [t.id for t in tasks]
+    assert task_api.count_tasks() == init_count + 5
+
+
+def test_add_tasks_missing_title(task_api):
+    init_count = task_api.count_tasks()
+    with pytest.raises(MissingTitle):
+        task_api.add_tasks([Task(title="ok"), Task()])
+    assert task_api.count_tasks() == init_count
+
+
+def test_defer_tasks(task_api):
+    ids = [str(id) for id in task_api.add_tasks([Task(title="a"), Task(title="b")])]
+    assert task_api.defer_tasks(ids) == 2
+    last_two = [str(t.id) for t in task_api.list_incomplet_by_last_deferred()[-2:]]
+    assert sorted(last_two) == sorted(ids)
+
+
+def test_defer_tasks_with_invalid_id(task_api):
+    with pytest.raises(InvalidTaskID):
+        task_api.defer_tasks([1234])
+
+
+def test_set_completed_many(task_api):
+    ids = [str(id) for id in task_api.add_tasks([Task(title="a"), Task(title="b")])]
+    assert task_api.set_completed_many(ids) == 2
+    assert all(task_api.get_task(id).is_completed for id in ids)
+    assert task_api.set_completed_many(ids, completed=False) == 2
+    assert not any(task_api.get_task(id).is_completed for id in ids)
+
+
+def test_delete_tasks(task_api):
+    ids = [str(id) for id in task_api.add_tasks([Task(title="a"), Task(title="b")])]
+    init_count = task_api.count_tasks()
+    assert task_api.delete_tasks(ids + [str(uuid4())]) == 2
+    assert task_api.count_tasks() == init_count - 2
+
+
+def test_clear_completed(task_api):
+    task_api.add_tasks(
+        [Task(title="done", is_completed=True), Task(title="todo", is_completed=False)]
+    )
+    task_api.clear_completed()
+    assert task_api.list_completed_tasks() == []
+    assert len(task_api.list_incomplete_tasks()) > 0
+
+
+@pytest.mark.parametrize(
+    "method", ["defer_task", "toggle_complete", "update_task_title", "delete_task"]
+)
+def test_single_statement_writes(task_api, method):
+    """Single task writes should issue one statement, not read the task first."""
+    id = str(task_api.add_task(Task(title="one statement")))
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(task_api._engine, "before_cursor_execute", count_statement)
+    try:
+        args = (id, "renamed") if method == "update_task_title" else (id,)
+        getattr(task_api, method)(*args)
+    finally:
+        event.remove(task_api._engine, "before_cursor_execute", count_statement)
+    # write-behind deferrals are written later, in batches
+    written_later = task_api.write_behind and method == "defer_task"
+    assert len(statements) == (0 if written_later else 1)
+
+
+def test_get_task_with_malformed_id(task_api):
+    with pytest.raises(InvalidTaskID):
+        task_api.get_task("not-a-uuid")
+
+
+@pytest.mark.parametrize("profile", list(profiles))
+def test_db_profile_pragmas(profile):
+    with TemporaryDirectory() as tmp_dir:
+        sqlite_url = f"sqlite:///{Path(tmp_dir) / test_db_file_name}"
+        api = TaskAPI(sqlite_url, profile=profile)
+        api.add_task(Task(title="task"))
+        with api._engine.connect() as conn:
+            journal_mode = conn.exec_driver_sql("PRAGMA journal_mode").scalar()
+            cache_size = conn.exec_driver_sql("PRAGMA cache_size").scalar()
+            busy_timeout = conn.exec_driver_sql("PRAGMA busy_timeout").scalar()
+        assert journal_mode.upper() == profiles[profile]["journal_mode"]
+        assert cache_size == profiles[profile]["cache_size"]
+        assert busy_timeout == profiles[profile]["busy_timeout"]
+        assert api.count_tasks() == 1
+
+
+def test_invalid_db_profile():
+    with TemporaryDirectory() as tmp_dir:
+        sqlite_url = f"sqlite:///{Path(tmp_dir) / test_db_file_name}"
+        with pytest.raises(InvalidDBProfile):
+            TaskAPI(sqlite_url, profile="turbo")
+
+
+def test_async_task_api():
+    """AsyncTaskAPI should give the same results as TaskAPI
+    with the calls running off the event loop thread.
+    """
+
+    async def run(api):
+        first_id = await api.add_task(Task(title="first"))
+        second_id = await api.add_task(Task(title="second"))
+        assert (await api.get_next_task()).id == first_id
+        await api.defer_task(str(first_id))
+        assert (await api.get_next_task()).id == second_id
+        completed = await api.toggle_complete(str(second_id))
+        assert completed.is_completed is True
+        with pytest.raises(TaskNotFound):
+            await api.get_task(str(uuid4()))
+        assert await api.count_tasks() == 2
+        assert await api.clear_completed() == 1
+        return await api.list_all_tasks()
+
+    with TemporaryDirectory() as tmp_dir:
+        sqlite_url = f"sqlite:///{Path(tmp_dir) / test_db_file_name}"
+        api = AsyncTaskAPI(sqlite_url, cache_queue=True)
+        try:
+            tasks = asyncio.run(run(api))
+        finally:
+            api.close()
+        assert [t.title for t in tasks] == ["first"]
+        assert api.sync.count_tasks() == 1
+
+
+def test_list_tasks_pages(task_api):
+    """Walking list_tasks() page by page should return every task
+    exactly once, in creation order.
+    """
+    task_api.add_tasks([Task(title=f"page task {i}") for i in range(7)])
+    all_ids = [t.id for t in task_api.list_tasks(limit=10_000)]
+    paged_ids = []
+    page = task_api.list_tasks(limit=3)
+    while page:
+        paged_ids.extend(t.id for t in page)
+        page = task_api.list_tasks(after=page[-1], limit=3)
+    assert paged_ids == all_ids
+    assert len(all_ids) == task_api.count_tasks()
+
+
+def test_list_tasks_by_status(task_api):
+    task_api.add_tasks(
+        [Task(title="done", is_completed=True), Task(title="todo", is_completed=False)]
+    )
+    completed = task_api.list_tasks(limit=10_000, status="completed")
+    active = task_api.list_tasks(limit=10_000, status="active")
+    assert completed and all(t.is_completed for t in completed)
+    assert active and not any(t.is_completed for t in active)
+    assert len(completed) + len(active) == task_api.count_tasks()
+
+
+def test_list_tasks_invalid_status(task_api):
+    with pytest.raises(InvalidStatus):
+        task_api.list_tasks(status="archived")
+
+
+def test_task_stats(task_api):
+    stats = task_api.task_stats()
+    assert stats.total == task_api.count_tasks()
+    assert stats.active == len(task_api.list_incomplete_tasks())
+    assert stats.completed == len(task_api.list_completed_tasks())
+    task_api.add_task(Task(title="done", is_completed=True))
+    new_stats = task_api.task_stats()
+    assert new_stats.total == stats.total + 1
+    assert new_stats.completed == stats.completed + 1
+
+
+def test_get_task_with_uuid(task_api):
+    id = task_api.add_task(Task(title="get me by UUID"))
+    assert task_api.get_task(id).id == id
+
+
+def test_migrate_to_compact_storage():
+    """Opening a DB in the default format with compact=True should rewrite it
+    with BLOB ids and INTEGER timestamps, keeping ids, timestamps and order.
+    """
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / test_db_file_name
+        sqlite_url = f"sqlite:///{db_path}"
+        legacy_api = TaskAPI(sqlite_url)
+        ids = legacy_api.add_tasks([Task(title=f"Task {i}") for i in range(20)])
+        legacy_api.defer_task(ids[0])
+        legacy_api.toggle_complete(ids[1])
+        before = legacy_api.list_tasks(limit=100)
+        queue_before = [t.id for t in legacy_api.list_incomplet_by_last_deferred()]
+        legacy_api._engine.dispose()
+
+        compact_api = TaskAPI(sqlite_url, compact=True)
+        assert compact_api.list_tasks(limit=100) == before
+        queue_after = [t.id for t in compact_api.list_incomplet_by_last_deferred()]
+        assert queue_after == queue_before
+        with sqlite3.connect(db_path) as conn:
+            types = conn.execute(
+                "SELECT typeof(id), typeof(created_at), typeof(last_deferred) "
+                "FROM task LIMIT 1"
+            ).fetchone()
+        assert types == ("blob", "integer", "integer")
+
+        # a compact DB stays compact, even when opened without compact=True
+        compact_api._engine.dispose()
+        reopened_api = TaskAPI(sqlite_url)
+        assert reopened_api.get_task(ids[2]).title == "Task 2"
+
+
+def test_list_task_rows_match_tasks(task_api):
+    task_api.add_tasks([Task(title="row 1"), Task(title="row 2", is_completed=True)])
+    tasks = task_api.list_tasks(limit=10_000)
+    rows = task_api.list_task_rows()
+    assert [
+        (r.id, r.title, r.is_completed, r.created_at, r.last_deferred) for r in rows
+    ] == [(t.id, t.title, t.is_completed, t.created_at, t.last_deferred) for t in tasks]
+
+
+def test_list_task_rows_pages(task_api):
+    rows = task_api.list_task_rows(status="active")
+    first_page = task_api.list_task_rows(limit=2, status="active")
+    second_page = task_api.list_task_rows(after=first_page[-1], limit=2, status="active")
+    assert [r.id for r in first_page + second_page] == [r.id for r in rows[:4]]
+
+
+def test_iter_task_rows(task_api):
+    rows = task_api.iter_task_rows(batch_size=2)
+    assert not isinstance(rows, list)
+    assert [r.id for r in rows] == [r.id for r in task_api.list_task_rows()]
+
+
+def test_task_row_queries_are_core(task_api):
+    """list_task_rows() and search_tasks() should run Core statements,
+    without ORM compilation or loading.
+    """
+    orm_statements = []
+
+    def record(state):
+        orm_statements.append(state.is_orm_statement)
+
+    event.listen(Session, "do_orm_execute", record)
+    try:
+        task_api.list_task_rows(limit=2, status="active")
+        task_api.search_tasks("task")
+        task_api.list_tasks(limit=2)
+    finally:
+        event.remove(Session, "do_orm_execute", record)
+    assert orm_statements == [False, False, True]
+
+
+def test_benchmark_smoke():
+    """A tiny benchmark run should time every operation."""
+    results = bench.run_benchmark(size=20, ops=3, heavy_ops=1, seed=1)
+    assert [r["operation"] for r in results] == list(bench.operations)
+    assert all(r["count"] > 0 and r["p50_ms"] >= 0 for r in results)
+
+
+def test_instrumentation_disabled_by_default(task_api):
+    assert task_api.instrumentation is None
+    assert task_api.stats_snapshot() == {}
+
+
+def test_instrumentation_records_calls():
+    with TemporaryDirectory() as tmp_dir:
+        sqlite_url = f"sqlite:///{Path(tmp_dir) / test_db_file_name}"
+        api = TaskAPI(sqlite_url, instrument=True)
+        ids = api.add_tasks([Task(title="a"), Task(title="b")])
+        api.toggle_complete(ids[0])
+        api.delete_task(ids[1])
+        api.list_all_tasks()
+        api.list_all_tasks()
+        with pytest.raises(TaskNotFound):
+            api.defer_task(uuid4())
+        api.delete_all_tasks()
+        stats = api.stats_snapshot()
+
+        assert stats["list_all_tasks"]["calls"] == 2
+        assert stats["list_all_tasks"]["statements"] == 2
+        assert stats["list_all_tasks"]["rows_returned"] == 2
+        assert sum(stats["list_all_tasks"]["histogram_ms"].values()) == 2
+        assert stats["toggle_complete"]["rows_returned"] == 1
+        assert stats["delete_task"]["rows_returned"] == 0
+        assert stats["delete_all_tasks"]["rows_affected"] == 1
+        assert stats["add_tasks"]["rows_affected"] == 2
+        assert stats["defer_task"]["errors"] == 1
+
+        stats_path = Path(tmp_dir) / "stats.json"
+        api.instrumentation.dump(stats_path)
+        assert json.loads(stats_path.read_text())["toggle_complete"]["calls"] == 1
+
+
+def test_schema_version_is_set():
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / test_db_file_name
+        TaskAPI(f"sqlite:///{db_path}")
+        with sqlite3.connect(db_path) as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        assert version == schema_version
+
+
+legacy_task_table_ddl = """
+CREATE TABLE task (
+    id CHAR(32) NOT NULL,
+    title VARCHAR NOT NULL,
+    is_completed BOOLEAN NOT NULL,
+    created_at DATETIME NOT NULL,
+    last_deferred DATETIME NOT NULL,
+    PRIMARY KEY (id)
+)
+"""
+
+
+def make_unversioned_db(db_path, size):
+    """Create a DB like the first app version did (no indexes, user_version 0)
+    holding size tasks.
+    """
+    base = datetime(2025, 1, 1)
+    rows = [
+        (
+            uuid4().hex,
+            f"Task {i}",
+            i % 3 == 0,
+            str(base + timedelta(seconds=i)),
+            str(base + timedelta(seconds=(i * 7919) % size)),
+        )
+        for i in range(size)
+    ]
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute(legacy_task_table_ddl)
+        conn.executemany("INSERT INTO task VALUES (?, ?, ?, ?, ?)", rows)
+    conn.close()
+
+
+def sqlite_state(db_path):
+    conn = sqlite3.connect(db_path)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    indexes = {
+        name
+        for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"
+        )
+    }
+    conn.close()
+    return version, indexes
+
+
+def test_upgrade_unversioned_db():
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / test_db_file_name
+        make_unversioned_db(db_path, 20_000)
+        api = TaskAPI(f"sqlite:///{db_path}")
+        version, indexes = sqlite_state(db_path)
+        assert version == schema_version
+        assert {index.name for index in Task.__table__.indexes} <= indexes
+        assert api.task_stats() == (20_000, 13_333, 6_667)
+        next_task = api.get_next_task()
+        queue = api.list_incomplet_by_last_deferred()
+        assert next_task.id == queue[0].id
+
+
+def test_migrate_to_compact_in_batches():
+    """The compact rewrite should copy rows in batch-sized transactions
+    and keep rowids, ids, timestamps and the queue order.
+    """
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / test_db_file_name
+        make_unversioned_db(db_path, 20_000)
+        api = TaskAPI(f"sqlite:///{db_path}")
+        tasks_before = api.list_task_rows()
+        queue_before = [t.id for t in api.list_incomplet_by_last_deferred()]
+        transactions = []
+
+        def count_transactions(conn, cursor, statement, *args):
+            if statement == "BEGIN IMMEDIATE":
+                transactions.append(statement)
+
+        api._engine.dispose()
+        # a new engine, the storage format of one is set before its first use
+        engine = create_engine(f"sqlite:///{db_path}")
+        event.listen(engine, "before_cursor_execute", count_transactions)
+        migrations.migrate_to_compact(engine, batch_size=3_000)
+        engine.dispose()
+        # task table: create table, 7 batches, the empty last read, the final
+        # swap. then the (empty) archive table: create, empty read, swap
+        assert len(transactions) == 13
+
+        api = TaskAPI(f"sqlite:///{db_path}")
+        tasks_after = api.list_task_rows()
+        assert [(t.id, t.title, t.created_at) for t in tasks_after] == [
+            (t.id, t.title, t.created_at) for t in tasks_before
+        ]
+        queue_after = [t.id for t in api.list_incomplet_by_last_deferred()]
+        assert queue_after == queue_before
+        assert sqlite_state(db_path)[1] >= {i.name for i in Task.__table__.indexes}
+
+
+def test_failed_migration_rolls_back(monkeypatch):
+    def broken_step(conn):
+        conn.exec_driver_sql("CREATE TABLE half_done (id INTEGER)")
+        raise RuntimeError("step failed")
+
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / test_db_file_name
+        api = TaskAPI(f"sqlite:///{db_path}")
+        monkeypatch.setattr(
+            migrations,
+            "migrations",
+            migrations.migrations + [(schema_version + 1, broken_step, False)],
+        )
+        with pytest.raises(RuntimeError):
+            migrations.migrate(api._engine, schema_version)
+        version, _ = sqlite_state(db_path)
+        conn = sqlite3.connect(db_path)
+        tables = conn.execute("SELECT name FROM sqlite_master").fetchall()
+        conn.close()
+        assert version == schema_version
+        assert ("half_done",) not in tables
+
+
+def test_rewrite_migration(monkeypatch):
+    def upper_titles(value, column):
+        return value.upper() if column.name == "title" else value
+
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / test_db_file_name
+        api = TaskAPI(f"sqlite:///{db_path}")
+        ids = api.add_tasks([Task(title=f"task {i}") for i in range(10)])
+        monkeypatch.setattr(
+            migrations,
+            "migrations",
+            migrations.migrations + [(schema_version + 1, upper_titles, True)],
+        )
+        migrations.migrate(api._engine, schema_version, batch_size=3)
+        assert sqlite_state(db_path)[0] == schema_version + 1
+        assert api.get_task(ids[4]).title == "TASK 4"
+        assert api.count_tasks() == 10
+
+
+def test_change_events(task_api):
+    """Every committed change should publish one event per affected task."""
+    task_api.delete_all_tasks()
+    events = []
+    unsubscribe = task_api.subscribe(events.append)
+    try:
+        first_id = task_api.add_task(Task(title="first"))
+        ids = task_api.add_tasks([Task(title="a"), Task(title="b")])
+        task_api.update_task_title(first_id, "renamed")
+        task_api.defer_task(first_id)
+        task_api.toggle_complete(first_id)
+        task_api.set_completed_many(ids + [first_id])
+        task_api.defer_tasks([ids[0]])
+        task_api.delete_task(ids[1])
+        task_api.clear_completed()
+        task_api.delete_all_tasks()
+    finally:
+        unsubscribe()
+    task_api.add_task(Task(title="not seen"))
+
+    assert [(event.kind, event.task_id) for event in events] == [
+        (TaskEventKind.ADDED, first_id),
+        (TaskEventKind.ADDED, ids[0]),
+        (TaskEventKind.ADDED, ids[1]),
+        (TaskEventKind.UPDATED, first_id),
+        (TaskEventKind.DEFERRED, first_id),
+        (TaskEventKind.COMPLETED, first_id),
+        (TaskEventKind.COMPLETED, ids[0]),
+        (TaskEventKind.COMPLETED, ids[1]),
+        (TaskEventKind.DEFERRED, ids[0]),
+        (TaskEventKind.DELETED, ids[1]),
+        (TaskEventKind.DELETED, first_id),
+        (TaskEventKind.DELETED, ids[0]),
+        (TaskEventKind.ALL_DELETED, None),
+    ]
+    assert events[3].task.title == "renamed"
+    assert events[-2].task.title == "a"
+
+
+def test_change_events_after_commit(tmp_path):
+    """Subscribers should see the change in the DB, and a failing
+    subscriber shouldn't fail the change or stop the others.
+    """
+    api = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}")
+    counts = []
+
+    def broken(event):
+        raise RuntimeError("subscriber failed")
+
+    api.subscribe(broken)
+    api.subscribe(lambda event: counts.append(api.count_tasks()))
+    api.add_task(Task(title="task"))
+    assert counts == [1]
+
+
+def test_async_change_events_on_loop():
+    """AsyncTaskAPI should deliver events in the event loop thread,
+    before the awaited call returns.
+    """
+
+    async def run(api):
+        loop_thread = threading.get_ident()
+        events = []
+        api.subscribe(lambda event: events.append((event, threading.get_ident())))
+        task_id = await api.add_task(Task(title="task"))
+        assert [(e.kind, e.task_id) for e, _ in events] == [
+            (TaskEventKind.ADDED, task_id)
+        ]
+        assert events[0][1] == loop_thread
+
+    with TemporaryDirectory() as tmp_dir:
+        api = AsyncTaskAPI(f"sqlite:///{Path(tmp_dir) / test_db_file_name}")
+        try:
+            asyncio.run(run(api))
+        finally:
+            api.close()
+
+
+def test_task_list_view_patches_controls():
+    """The task list view should apply changes to the affected control only."""
+    from task_list_view import ListTasksView
+
+    with TemporaryDirectory() as tmp_dir:
+        api = AsyncTaskAPI(f"sqlite:///{Path(tmp_dir) / test_db_file_name}")
+        try:
+            ids = api.sync.add_tasks([Task(title=f"task {i}") for i in range(3)])
+            view = ListTasksView(api)
+            view.build()
+            controls = list(view.tasks.controls)
+
+            api.sync.toggle_complete(ids[1])
+            api.sync.update_task_title(ids[2], "renamed")
+            new_id = api.sync.add_task(Task(title="new"))
+            api.sync.delete_task(ids[0])
+
+            assert view.tasks.controls[:2] == controls[1:]
+            assert controls[1].display_task.value is True
+            assert controls[2].display_task.label == "renamed"
+            assert view.tasks.controls[2].task.id == new_id
+            assert (view.total_count, view.active_count) == (3, 2)
+            api.sync.clear_completed()
+            assert [c.task.id for c in view.tasks.controls] == [ids[2], new_id]
+            assert (view.total_count, view.active_count) == (2, 2)
+        finally:
+            api.close()
+
+
+def test_task_list_view_reconcile():
+    """Refreshing the task list should reuse the controls of the tasks
+    still shown and only touch the ones that changed.
+    """
+    from models import TaskRow
+    from task_list_view import ListChanges, ListTasksView
+
+    with TemporaryDirectory() as tmp_dir:
+        api = AsyncTaskAPI(f"sqlite:///{Path(tmp_dir) / test_db_file_name}")
+        try:
+            view = ListTasksView(api)
+            tasks = [Task(title=f"task {i}") for i in range(5)]
+            assert view.reconcile(tasks) == ListChanges(5, 0, 0, 0)
+            controls = list(view.tasks.controls)
+
+            assert view.reconcile(tasks).touched == 0
+            assert view.tasks.controls == controls
+
+            new_task = Task(title="new")
+            changed = TaskRow(
+                tasks[3].id, "renamed", True, tasks[3].created_at, None
+            )
+            changes = view.reconcile([tasks[0], changed, tasks[2], tasks[1], new_task])
+            assert changes == ListChanges(added=1, updated=1, moved=2, removed=1)
+            assert view.tasks.controls[:4] == [
+                controls[0],
+                controls[3],
+                controls[2],
+                controls[1],
+            ]
+            assert controls[3].display_task.label == "renamed"
+            assert set(view.task_controls) == {
+                tasks[0].id,
+                tasks[1].id,
+                tasks[2].id,
+                tasks[3].id,
+                new_task.id,
+            }
+        finally:
+            api.close()
+
+
+def test_search_tasks(task_api):
+    task_api.delete_all_tasks()
+    milk_id, bread_id, _ = task_api.add_tasks(
+        [
+            Task(title="Buy milk"),
+            Task(title="buy bread and milk", is_completed=True),
+            Task(title="walk the dog"),
+        ]
+    )
+    assert [t.id for t in task_api.search_tasks("mil")] == [milk_id, bread_id]
+    assert [t.id for t in task_api.search_tasks("BU MI", status="completed")] == [
+        bread_id
+    ]
+    assert task_api.search_tasks('milk" OR "dog') == []
+    assert task_api.search_tasks("  ") == []
+    with pytest.raises(InvalidStatus):
+        task_api.search_tasks("milk", status="done")
+
+    task_api.update_task_title(milk_id, "Buy eggs")
+    assert [t.title for t in task_api.search_tasks("egg")] == ["Buy eggs"]
+    assert [t.id for t in task_api.search_tasks("milk")] == [bread_id]
+    task_api.delete_task(bread_id)
+    assert task_api.search_tasks("milk") == []
+
+
+def test_search_after_migrations():
+    """Tasks of an upgraded DB should be searchable, and stay so after
+    the task table is rewritten.
+    """
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / test_db_file_name
+        make_unversioned_db(db_path, 100)
+        api = TaskAPI(f"sqlite:///{db_path}")
+        assert [t.title for t in api.search_tasks("task 42")] == ["Task 42"]
+        api._engine.dispose()
+
+        api = TaskAPI(f"sqlite:///{db_path}", compact=True)
+        assert [t.title for t in api.search_tasks("task 42")] == ["Task 42"]
+        api.add_task(Task(title="after rewrite"))
+        assert len(api.search_tasks("rewrite")) == 1
+
+
+def test_task_list_view_search(monkeypatch):
+    """Typing in the search box should run a single search once typing pauses."""
+    import task_list_view
+    from task_list_view import ListTasksView
+
+    monkeypatch.setattr(task_list_view, "search_delay", 0.01)
+    with TemporaryDirectory() as tmp_dir:
+        api = AsyncTaskAPI(f"sqlite:///{Path(tmp_dir) / test_db_file_name}")
+        searches = []
+        monkeypatch.setattr(
+            api,
+            "search_tasks",
+            lambda *args, **kwargs: searches.append(args) or asyncio.sleep(0, []),
+        )
+
+        async def type_text(view):
+            typing = []
+            for text in ("b", "bu", "buy"):
+                view.search.value = text
+                typing.append(asyncio.create_task(view.search_changed(None)))
+            await asyncio.gather(*typing)
+
+        try:
+            view = ListTasksView(api)
+            view.update = lambda: None
+            asyncio.run(type_text(view))
+        finally:
+            api.close()
+        assert searches == [("buy",)]
+        assert view.all_loaded
+
+
+def test_archive_completed(task_api):
+    task_api.delete_all_tasks()
+    now = datetime.now()
+    old_id, recent_id, open_id = task_api.add_tasks(
+        [
+            Task(title="old", is_completed=True, completed_at=now - timedelta(days=40)),
+            Task(title="recent", is_completed=True),
+            Task(title="open"),
+        ]
+    )
+    events = []
+    unsubscribe = task_api.subscribe(events.append)
+    try:
+        assert task_api.archive_completed(timedelta(days=30)) == 1
+    finally:
+        unsubscribe()
+    assert [(e.kind, e.task_id) for e in events] == [(TaskEventKind.ARCHIVED, old_id)]
+    assert task_api.task_stats() == (2, 1, 1)
+    assert task_api.count_archived_tasks() == 1
+    with pytest.raises(TaskNotFound):
+        task_api.get_task(old_id)
+    assert task_api.get_next_task().id == open_id
+
+    archived = task_api.list_archived_tasks()
+    assert [(t.id, t.title) for t in archived] == [(old_id, "old")]
+    assert archived[0].completed_at == now - timedelta(days=40)
+
+    restored = task_api.restore_task(str(old_id))
+    assert restored.is_completed and restored.title == "old"
+    assert task_api.count_archived_tasks() == 0
+    assert task_api.get_task(old_id).completed_at == now - timedelta(days=40)
+    with pytest.raises(TaskNotFound):
+        task_api.restore_task(old_id)
+
+
+def test_archive_completed_in_batches(task_api):
+    task_api.delete_all_tasks()
+    ids = task_api.add_tasks(
+        [Task(title=f"done {i}", is_completed=True) for i in range(7)]
+        + [Task(title="open")]
+    )
+    assert task_api.archive_completed(datetime.now(), batch_size=3) == 7
+    assert task_api.count_tasks() == 1
+    first_page = task_api.list_archived_tasks(limit=4)
+    second_page = task_api.list_archived_tasks(after=first_page[-1], limit=4)
+    assert {t.id for t in first_page + second_page} == set(ids[:7])
+    assert task_api.search_tasks("done") == []
+
+
+def test_completed_at(task_api):
+    task_id = task_api.add_task(Task(title="task"))
+    assert task_api.get_task(task_id).completed_at is None
+    assert task_api.toggle_complete(task_id).completed_at is not None
+    assert task_api.toggle_complete(task_id).completed_at is None
+    task_api.set_completed_many([task_id])
+    assert task_api.get_task(task_id).completed_at is not None
+    task_api.set_completed_many([task_id], completed=False)
+    assert task_api.get_task(task_id).completed_at is None
+
+
+def test_archive_migrated_to_compact():
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / test_db_file_name
+        make_unversioned_db(db_path, 30)
+        api = TaskAPI(f"sqlite:///{db_path}")
+        archived = api.archive_completed(datetime.now())
+        assert archived == 10
+        before = [(t.id, t.completed_at) for t in api.list_archived_tasks()]
+        api._engine.dispose()
+
+        api = TaskAPI(f"sqlite:///{db_path}", compact=True)
+        assert [(t.id, t.completed_at) for t in api.list_archived_tasks()] == before
+        api.restore_task(before[0][0])
+        assert api.count_archived_tasks() == archived - 1
+
+
+def test_interrupted_migration_to_compact(monkeypatch, tmp_path):
+    """An archive left in the default format by an interrupted migration
+    to compact should be rewritten the next time the DB is opened.
+    """
+    db_path = tmp_path / test_db_file_name
+    make_unversioned_db(db_path, 30)
+    api = TaskAPI(f"sqlite:///{db_path}")
+    api.archive_completed(datetime.now())
+    before = [(t.id, t.completed_at) for t in api.list_archived_tasks()]
+    api.close()
+    rewrite_task_table = migrations.rewrite_task_table
+
+    def crash_before_archive(engine, convert_value, batch_size, table):
+        if table.name == "task_archive":
+            raise KeyboardInterrupt
+        rewrite_task_table(engine, convert_value, batch_size, table=table)
+
+    monkeypatch.setattr(migrations, "rewrite_task_table", crash_before_archive)
+    with pytest.raises(KeyboardInterrupt):
+        TaskAPI(f"sqlite:///{db_path}", compact=True)
+    monkeypatch.undo()
+
+    api = TaskAPI(f"sqlite:///{db_path}")
+    assert api._engine.dialect.compact_storage
+    assert [(t.id, t.completed_at) for t in api.list_archived_tasks()] == before
+    api.restore_task(before[0][0])
+    assert api.count_archived_tasks() == len(before) - 1
+    api.close()
+
+
+def test_unit_of_work(task_api):
+    """Calls in a unit of work should be committed together, with their
+    events published (and the queue updated) only once committed.
+    """
+    task_api.delete_all_tasks()
+    events = []
+    unsubscribe = task_api.subscribe(events.append)
+    try:
+        with task_api.unit_of_work():
+            first_id = task_api.add_task(Task(title="first"))
+            task_api.update_task_title(first_id, "renamed")
+            # reads see the writes of the unit of work
+            assert task_api.get_task(first_id).title == "renamed"
+            assert events == []
+        assert [e.kind for e in events] == [TaskEventKind.ADDED, TaskEventKind.UPDATED]
+        assert task_api.get_next_task().title == "renamed"
+
+        with pytest.raises(TaskNotFound):
+            with task_api.unit_of_work():
+                task_api.add_task(Task(title="rolled back"))
+                task_api.toggle_complete(first_id)
+                with task_api.unit_of_work():
+                    task_api.defer_task(uuid4())
+    finally:
+        unsubscribe()
+    assert len(events) == 2
+    assert task_api.count_tasks() == 1
+    next_task = task_api.get_next_task()
+    assert (next_task.id, next_task.is_completed) == (first_id, False)
+
+
+def test_sessions_reused(tmp_path):
+    """Calls should reuse the thread's session, not its connection."""
+    api = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}")
+    task_id = api.add_task(Task(title="task"))
+    session = api._sessions._thread_session()
+    for _ in range(5):
+        api.get_task(task_id)
+        api.count_tasks()
+        api.list_task_rows()
+        assert api._engine.pool.checkedout() == 0
+    assert api._sessions._thread_session() is session
+    with api.unit_of_work():
+        api.count_tasks()
+        api.count_tasks()
+        assert api._engine.pool.checkedout() == 1
+    assert api._engine.pool.checkedout() == 0
+    api.close()
+
+
+def test_calls_from_many_threads(tmp_path):
+    """Calls from more threads than the pool has connections shouldn't
+    wait for one.
+    """
+    api = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}")
+    api.add_task(Task(title="task"))
+    pool = api._engine.pool
+    counts = []
+    for _ in range(pool.size() + pool._max_overflow + 5):
+        thread = threading.Thread(target=lambda: counts.append(api.count_tasks()))
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+    assert counts == [1] * len(counts)
+    assert pool.checkedout() == 0
+    api.close()
+
+
+def test_overhead_benchmark_smoke():
+    results = bench.run_overhead_benchmark(ops=20)
+    assert all(r["count"] > 0 for r in results)
+
+
+def test_write_behind_deferrals(tmp_path):
+    """Write-behind deferrals should be applied in memory right away and
+    written in batches, a crash losing only the ones not flushed yet.
+    """
+    url = f"sqlite:///{tmp_path / test_db_file_name}"
+    api = TaskAPI(url, write_behind=True, flush_interval=60, flush_count=10)
+    ids = api.add_tasks([Task(title=f"task {i}") for i in range(30)])
+    added = {task.id: task.last_deferred for task in api.list_all_tasks()}
+    commits = []
+    event.listen(api._engine, "commit", lambda conn: commits.append(conn))
+    events = []
+    api.subscribe(events.append)
+
+    deferred = []
+    for _ in range(23):
+        task = api.get_next_task()
+        api.defer_task(task.id)
+        deferred.append(task.id)
+    # in memory: the queue moved on and the events were published
+    assert deferred == ids[:23]
+    assert api.get_next_task().id == ids[23]
+    assert [e.task_id for e in events] == deferred
+    assert all(e.kind == TaskEventKind.DEFERRED for e in events)
+    # in the DB: two batches of 10, 3 still pending
+    assert len(commits) == 2
+
+    # another process (or this one after a crash) sees the flushed ones only
+    other = TaskAPI(url)
+
+    def written(id):
+        return other.get_task(id).last_deferred != added[id]
+
+    assert all(written(id) for id in deferred[:20])
+    assert not any(written(id) for id in deferred[20:])
+    assert api.flush() == 3
+    assert all(written(id) for id in deferred)
+    assert len(commits) == 3
+    other.close()
+
+    # other calls see the pending deferrals
+    api.defer_task(ids[0])
+    assert api.list_incomplet_by_last_deferred()[-1].id == ids[0]
+    assert len(commits) == 4
+    # completed and unknown tasks aren't deferred behind
+    api.toggle_complete(ids[1])
+    api.defer_task(ids[1])
+    with pytest.raises(TaskNotFound):
+        api.defer_task(uuid4())
+    api.defer_task(ids[2])
+    api.close()
+    assert TaskAPI(url).list_incomplet_by_last_deferred()[-1].id == ids[2]
+
+
+def test_write_behind_timed_and_failed_flush(tmp_path):
+    """Pending deferrals should be flushed after flush_interval and kept
+    pending if writing them fails.
+    """
+    url = f"sqlite:///{tmp_path / test_db_file_name}"
+    api = TaskAPI(url, write_behind=True, flush_interval=0.05)
+    task_id = api.add_task(Task(title="task"))
+    api.defer_task(task_id)
+    deadline = time.monotonic() + 5
+    while api._deferrals and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert api._deferrals == {}
+
+    api.flush_interval = 60
+    api.defer_task(task_id)
+    deferred_at = api.get_next_task().last_deferred
+    # fail at once instead of waiting for the lock
+    api._sessions.close()
+    api._engine.dispose()
+    event.listen(
+        api._engine,
+        "connect",
+        lambda conn, record: conn.execute("PRAGMA busy_timeout = 0"),
+    )
+    locker = sqlite3.connect(tmp_path / test_db_file_name)
+    locker.execute("BEGIN EXCLUSIVE")
+    with pytest.raises(OperationalError):
+        api.flush()
+    assert api._deferrals == {task_id: deferred_at}
+    locker.rollback()
+    locker.close()
+    assert api.flush() == 1
+    assert TaskAPI(url).get_task(task_id).last_deferred == deferred_at
+    api.close()
+
+
+def test_write_behind_flusher_thread(tmp_path):
+    """Timed flushes should all run on one thread, holding no connection."""
+
+    def flushers():
+        return {t for t in threading.enumerate() if t.name == "task-flusher"}
+
+    other_flushers = flushers()
+    api = TaskAPI(
+        f"sqlite:///{tmp_path / test_db_file_name}",
+        write_behind=True,
+        flush_interval=0.01,
+    )
+    task_id = api.add_task(Task(title="task"))
+    for _ in range(20):
+        api.defer_task(task_id)
+        deadline = time.monotonic() + 5
+        while api._deferrals or api._engine.pool.checkedout():
+            assert time.monotonic() < deadline
+            time.sleep(0.005)
+    assert flushers() - other_flushers == {api._flusher}
+    api.close()
+    assert not api._flusher.is_alive()
+
+
+def test_write_behind_defer_racing_completion(tmp_path):
+    """A task completed by another thread while it's being deferred behind
+    shouldn't be put back in the queue.
+    """
+    url = f"sqlite:///{tmp_path / test_db_file_name}"
+    api = TaskAPI(url, write_behind=True, flush_interval=60)
+    first_id, second_id = api.add_tasks([Task(title="a"), Task(title="b")])
+    update = api._queue.update
+    completers = []
+
+    def update_while_completing(id, change):
+        def complete_then_change(queued):
+            completer = threading.Thread(target=api.toggle_complete, args=(id,))
+            completer.start()
+            completers.append(completer)
+            # it's committed, its queue update waits for this one
+            completer.join(0.2)
+            return change(queued)
+
+        return update(id, complete_then_change)
+
+    api._queue.update = update_while_completing
+    api.defer_task(first_id)
+    completers[0].join(5)
+    assert api.get_task(first_id).is_completed
+    assert api.get_next_task().id == second_id
+    api.close()
+
+
+def test_write_behind_flush_in_rolled_back_unit_of_work(tmp_path):
+    """Deferrals flushed by a call in a unit of work that is rolled back
+    should be pending again, not lost.
+    """
+    url = f"sqlite:///{tmp_path / test_db_file_name}"
+    api = TaskAPI(url, write_behind=True, flush_interval=60)
+    first_id, second_id = api.add_tasks([Task(title="a"), Task(title="b")])
+    api.defer_task(first_id)
+    with pytest.raises(RuntimeError):
+        with api.unit_of_work():
+            api.update_task_title(second_id, "renamed")
+            raise RuntimeError("rolled back")
+    assert list(api._deferrals) == [first_id]
+    assert api.get_task(second_id).title == "b"
+    api.close()
+    assert TaskAPI(url).get_next_task().id == second_id
+
+
+@pytest.mark.parametrize("format", ["jsonl", "csv"])
+def test_export_import_tasks(task_api, tmp_path, format):
+    """Exported tasks should be imported back as they were, ids and
+    timestamps included, in chunks of chunk_size.
+    """
+    task_api.delete_all_tasks()
+    task_api.add_tasks([Task(title=f"task {i}, \"quoted\"\n") for i in range(25)])
+    task_api.toggle_complete(task_api.get_next_task().id)
+    task_api.defer_task(task_api.get_next_task().id)
+    exported = [
+        (t.id, t.title, t.is_completed, t.created_at, t.last_deferred, t.completed_at)
+        for t in task_api.list_all_tasks()
+    ]
+    path = tmp_path / f"tasks.{format}"
+    with open(path, "w", newline="", encoding="utf-8") as stream:
+        stats = task_api.export_tasks(stream, format)
+    assert stats.rows == 25 and stats.rows_per_sec > 0
+
+    task_api.delete_all_tasks()
+    events = []
+    unsubscribe = task_api.subscribe(events.append)
+    commits = []
+
+    def count_commit(conn):
+        commits.append(conn)
+
+    event.listen(task_api._engine, "commit", count_commit)
+    try:
+        with open(path, newline="", encoding="utf-8") as stream:
+            stats = task_api.import_tasks(stream, format, chunk_size=10)
+    finally:
+        event.remove(task_api._engine, "commit", count_commit)
+        unsubscribe()
+    assert stats.rows == 25
+    assert len(commits) == 3
+    assert [e.kind for e in events] == [TaskEventKind.IMPORTED]
+    imported = [
+        (t.id, t.title, t.is_completed, t.created_at, t.last_deferred, t.completed_at)
+        for t in task_api.list_all_tasks()
+    ]
+    assert sorted(imported) == sorted(exported)
+    assert task_api.get_next_task().id == min(
+        (row[4], row[0]) for row in exported if not row[2]
+    )[1]
+
+
+def test_import_tasks_errors(task_api):
+    task_api.delete_all_tasks()
+    lines = [
+        '{"title": "no id nor timestamps", "is_completed": true}',
+        "",
+        '{"title": "second"}',
+        '{"title": ""}',
+    ]
+    with pytest.raises(InvalidImport, match="line 4"):
+        task_api.import_tasks(io.StringIO("\n".join(lines)), chunk_size=2)
+    # the first chunk was imported
+    tasks = task_api.list_all_tasks()
+    assert len(tasks) == 2
+    completed = next(t for t in tasks if t.is_completed)
+    assert completed.completed_at is not None
+
+    stream = io.StringIO()
+    task_api.export_tasks(stream, "csv", status="completed")
+    with pytest.raises(InvalidImport, match="already exists"):
+        task_api.import_tasks(io.StringIO(stream.getvalue()), "csv")
+    with pytest.raises(InvalidImport, match="line 1: invalid JSON"):
+        task_api.import_tasks(io.StringIO("not json"))
+    with pytest.raises(InvalidImport, match="invalid ISO datetime"):
+        task_api.import_tasks(io.StringIO('{"title": "t", "created_at": "soon"}'))
+    with pytest.raises(InvalidImport, match="invalid task id: 5"):
+        task_api.import_tasks(io.StringIO('{"title": "t", "id": 5}'))
+    with pytest.raises(InvalidFormat):
+        task_api.export_tasks(io.StringIO(), "xml")
+    assert task_api.count_tasks() == 2
+
+    # timestamps with an offset are imported in local time
+    created_at = datetime(2024, 1, 1, tzinfo=timezone(timedelta(hours=2)))
+    record = {"id": str(uuid4()), "title": "t", "created_at": created_at.isoformat()}
+    task_api.import_tasks(io.StringIO(json.dumps(record)))
+    task = task_api.get_task(record["id"])
+    assert task.created_at == created_at.astimezone().replace(tzinfo=None)
+
+
+def test_server(tmp_path):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from server import create_app
+
+    app = create_app(f"sqlite:///{tmp_path / test_db_file_name}")
+    with TestClient(app) as client:
+        assert client.get("/tasks/next").status_code == 404
+        first = client.post("/tasks", json={"title": "first"}).json()
+        second = client.post("/tasks", json={"title": "second"}).json()
+        assert client.get("/tasks/next").json()["id"] == first["id"]
+        assert client.post(f"/tasks/{first['id']}/defer").status_code == 204
+        assert client.get("/tasks/next").json()["id"] == second["id"]
+
+        completed = client.post(f"/tasks/{second['id']}/complete").json()
+        assert completed["is_completed"] and completed["completed_at"]
+        assert client.get("/stats").json() == {"total": 2, "active": 1, "completed": 1}
+        listed = client.get("/tasks", params={"status": "active"}).json()
+        assert [t["id"] for t in listed] == [first["id"]]
+        page = client.get("/tasks", params={"limit": 1}).json()
+        next_page = client.get("/tasks", params={"after": page[0]["id"]}).json()
+        assert {page[0]["id"], next_page[0]["id"]} == {first["id"], second["id"]}
+        found = client.get("/tasks/search", params={"q": "sec"}).json()
+        assert found == [{key: completed[key] for key in found[0]}]
+        assert set(found[0]) == set(listed[0])
+
+        renamed = client.patch(f"/tasks/{first['id']}", json={"title": "renamed"})
+        assert renamed.json()["title"] == "renamed"
+        assert client.delete(f"/tasks/{first['id']}").status_code == 204
+        assert client.get(f"/tasks/{first['id']}").status_code == 404
+        assert client.post("/tasks/not-an-id/defer").status_code == 422
+        assert client.post("/tasks", json={"title": ""}).status_code == 422
+
+
+def test_http_benchmark_smoke(tmp_path):
+    """Concurrent clients against a server running in a thread."""
+    uvicorn = pytest.importorskip("uvicorn")
+    pytest.importorskip("httpx")
+    from server import create_app
+
+    app = create_app(f"sqlite:///{tmp_path / test_db_file_name}")
+    server = uvicorn.Server(uvicorn.Config(app, port=0, log_level="warning"))
+    thread = threading.Thread(target=server.run)
+    thread.start()
+    try:
+        while not server.started:
+            assert thread.is_alive()
+            threading.Event().wait(0.01)
+        port = server.servers[0].sockets[0].getsockname()[1]
+        results = bench.run_http_benchmark(f"http://127.0.0.1:{port}", 20, clients=5)
+    finally:
+        server.should_exit = True
+        thread.join()
+    total = next(r for r in results if r["operation"] == "http:all")
+    assert total["count"] > 0 and total["ops_per_sec"] > 0
+
+
+def test_call_with_retry():
+    calls = []
+    busy = sqlite3.OperationalError("database is locked")
+
+    def busy_twice():
+        calls.append(1)
+        if len(calls) <= 2:
+            raise OperationalError("", {}, busy)
+        return "done"
+
+    assert call_with_retry(busy_twice, backoff=0.001) == "done"
+    assert len(calls) == 3
+    calls.clear()
+    with pytest.raises(OperationalError):
+        call_with_retry(busy_twice, retries=1, backoff=0.001)
+
+    def other_error():
+        calls.append(1)
+        raise OperationalError("", {}, sqlite3.OperationalError("no such table"))
+
+    calls.clear()
+    with pytest.raises(OperationalError):
+        call_with_retry(other_error, backoff=0.001)
+    assert len(calls) == 1
+
+
+def test_concurrent_api_write_queue(tmp_path):
+    """Writes should be applied in order by the writer thread, submitting
+    failing once the bounded queue is full.
+    """
+    api = ConcurrentTaskAPI(
+        f"sqlite:///{tmp_path / test_db_file_name}",
+        write_queue_size=2,
+        submit_timeout=0,
+    )
+    started, release = threading.Event(), threading.Event()
+
+    def block(sync):
+        started.set()
+        return release.wait(5)
+
+    blocked = api.unit_of_work(block)
+    assert started.wait(5)
+    # the writer is busy with the first one, two more fill the queue
+    queued = [api.add_task(Task(title=f"task {i}")) for i in range(2)]
+    with pytest.raises(WriteQueueFull):
+        api.add_task(Task(title="one too many"))
+    release.set()
+    assert blocked.result(5) is True
+    ids = [future.result(5) for future in queued]
+    assert api.list_all_tasks().result() == api.sync.list_all_tasks()
+    assert [t.id for t in api.list_tasks().result()][: len(ids)] == ids
+    with pytest.raises(TaskNotFound):
+        api.defer_task(uuid4()).result(5)
+    api.close()
+    with pytest.raises(RuntimeError):
+        api.add_task(Task(title="closed"))
+
+
+def test_concurrent_api_stress(tmp_path):
+    """Many threads writing and reading at once, with another connection
+    writing to the same DB, should neither fail nor lose a write.
+    """
+    url = f"sqlite:///{tmp_path / test_db_file_name}"
+    api = ConcurrentTaskAPI(url, cache_queue=True)
+    other = TaskAPI(url, profile="balanced")
+    threads_count, ops = 8, 25
+    errors = []
+
+    def client(n):
+        try:
+            futures = []
+            for i in range(ops):
+                task_id = api.add_task(Task(title=f"task {n}-{i}")).result()
+                futures.append(api.defer_task(task_id))
+                if i % 5 == 0:
+                    futures.append(api.toggle_complete(task_id))
+                futures.append(api.get_task(task_id))
+                futures.append(api.task_stats())
+                futures.append(api.list_task_rows(limit=20))
+            for future in futures:
+                future.result()
+        except Exception as e:
+            errors.append(e)
+
+    def other_writer():
+        for i in range(ops):
+            other.add_task(Task(title=f"other {i}"))
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(threads_count)]
+    threads.append(threading.Thread(target=other_writer))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    stats = api.task_stats().result()
+    assert stats.total == threads_count * ops + ops
+    assert stats.completed == threads_count * ops // 5
+    other.close()
+    api.close()
+
+
+def test_task_lists(task_api):
+    """Every call should only see the tasks of the API's list."""
+    task_api.delete_all_tasks()
+    home = task_api.for_list("home")
+    assert task_api.for_list("home") is home
+    assert home.for_list(task_api.list_id) is task_api
+    with pytest.raises(InvalidListID):
+        task_api.for_list("../home")
+
+    events = []
+    unsubscribe = home.subscribe(events.append)
+    try:
+        default_ids = task_api.add_tasks([Task(title=f"task {i}") for i in range(3)])
+        home_id = home.add_task(Task(title="water the plants"))
+        home.defer_task(home_id)
+    finally:
+        unsubscribe()
+    assert [e.kind for e in events] == [TaskEventKind.ADDED, TaskEventKind.DEFERRED]
+    assert home.get_next_task().id == home_id
+    assert task_api.get_next_task().id == default_ids[0]
+    assert (home.count_tasks(), task_api.count_tasks()) == (1, 3)
+    assert home.task_stats() == (1, 1, 0)
+    assert [t.id for t in home.list_task_rows()] == [home_id]
+    assert [t.id for t in home.search_tasks("plants")] == [home_id]
+    assert task_api.search_tasks("plants") == []
+    with pytest.raises(TaskNotFound):
+        task_api.get_task(home_id)
+    with pytest.raises(TaskNotFound):
+        task_api.toggle_complete(home_id)
+    assert task_api.delete_tasks([home_id]) == 0
+    assert {"home", task_api.list_id} <= set(task_api.list_ids())
+
+    home.toggle_complete(home_id)
+    task_api.toggle_complete(default_ids[0])
+    archived = task_api.count_archived_tasks()
+    assert home.archive_completed(timedelta(0)) == 1
+    assert home.count_archived_tasks() == 1
+    assert task_api.count_archived_tasks() == archived
+    with pytest.raises(TaskNotFound):
+        task_api.restore_task(home_id)
+    assert home.restore_task(home_id).list_id == "home"
+
+    home.delete_all_tasks()
+    assert home.count_tasks() == 0
+    assert task_api.count_tasks() == 3
+
+
+def test_task_list_shards(tmp_path):
+    """With shards=True every other list should get a DB file of its own."""
+    api = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}", shards=True)
+    api.add_task(Task(title="default list task"))
+    work = api.for_list("work")
+    work_id = work.add_task(Task(title="write report"))
+    assert (tmp_path / "lists" / "work.sqlite3").exists()
+    assert work._engine is not api._engine
+    assert work.for_list(api.list_id) is api
+    assert work.get_next_task().id == work_id
+    assert (api.count_tasks(), work.count_tasks()) == (1, 1)
+    assert api.list_ids() == ["default", "work"]
+    api.close()
+
+    reopened = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}", shards=True)
+    assert reopened.list_ids() == ["default", "work"]
+    assert reopened.for_list("work").get_task(work_id).title == "write report"
+    reopened.close()
+
+
+def test_concurrent_and_async_api_lists(tmp_path):
+    url = f"sqlite:///{tmp_path / test_db_file_name}"
+    api = ConcurrentTaskAPI(url)
+    home = api.for_list("home")
+    home.add_task(Task(title="home task")).result()
+    assert (api.count_tasks().result(), home.count_tasks().result()) == (0, 1)
+    api.close()
+    with pytest.raises(RuntimeError):
+        home.add_task(Task(title="closed"))
+
+    async def count_home_tasks():
+        async_api = AsyncTaskAPI(url)
+        try:
+            return await async_api.for_list("home").count_tasks()
+        finally:
+            async_api.close()
+
+    assert asyncio.run(count_home_tasks()) == 1
+
+
+def test_backup_while_writing(tmp_path):
+    """A backup taken while another thread writes should be a consistent,
+    standalone copy of the DB.
+    """
+    api = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}", profile="balanced")
+    api.add_tasks([Task(title=f"Task {i}") for i in range(2_000)])
+    writer_api = TaskAPI(api.db_url, profile="balanced")
+    stop = threading.Event()
+
+    def write():
+        while not stop.is_set():
+            writer_api.add_task(Task(title="written during the backup"))
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        path = api.backup(tmp_path / "backup.sqlite3", pages=4, sleep=0)
+    finally:
+        stop.set()
+        writer.join()
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    assert conn.execute("SELECT count(*) FROM task").fetchone()[0] >= 2_000
+    conn.close()
+    assert not (tmp_path / "backup.sqlite3.partial").exists()
+    api.close()
+    writer_api.close()
+
+
+@pytest.mark.parametrize("options", [{}, {"cache_queue": True}, {"compact": True}])
+def test_restore(tmp_path, options):
+    api = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}", **options)
+    kept_id = api.add_task(Task(title="kept"))
+    work = api.for_list("work")
+    work.add_task(Task(title="work task"))
+    path = api.backup(tmp_path / "backup.sqlite3")
+    api.add_task(Task(title="added after the backup"))
+    api.delete_task(kept_id)
+    events = []
+    api.subscribe(events.append)
+    work.subscribe(events.append)
+
+    api.restore(path)
+    assert [task.title for task in api.list_all_tasks()] == ["kept"]
+    assert api.get_next_task().id == kept_id
+    assert work.count_tasks() == 1
+    assert [event.kind for event in events] == [TaskEventKind.REPLACED] * 2
+    assert not list(tmp_path.glob("*.restore*"))
+    api.add_task(Task(title="added after the restore"))
+    assert api.count_tasks() == 2
+    api.close()
+
+
+def test_restore_while_reading(tmp_path):
+    """restore() should wait for the reads in progress and hold off new
+    ones, never closing a connection in use.
+    """
+    api = ConcurrentTaskAPI(f"sqlite:///{tmp_path / test_db_file_name}")
+    api.add_tasks([Task(title=f"Task {i}") for i in range(5_000)]).result()
+    path = api.backup(tmp_path / "backup.sqlite3").result()
+    stop = threading.Event()
+    errors = []
+
+    def read():
+        while not stop.is_set():
+            try:
+                assert len(api.list_task_rows(limit=None).result()) == 5_000
+                assert api.task_stats().result().total == 5_000
+            except Exception as e:
+                errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    try:
+        for _ in range(10):
+            api.restore(path).result()
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+    assert errors == []
+    api.close()
+
+
+def test_restore_drops_pending_deferrals(tmp_path):
+    api = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}", write_behind=True)
+    first_id = api.add_task(Task(title="first"))
+    api.add_task(Task(title="second"))
+    path = api.backup(tmp_path / "backup.sqlite3")
+    api.defer_task(first_id)
+    api.restore(path)
+    assert api.flush() == 0
+    assert api.get_next_task().id == first_id
+    api.close()
+
+
+def test_restore_older_and_compact_backups(tmp_path):
+    legacy_path = tmp_path / "legacy.sqlite3"
+    make_unversioned_db(legacy_path, 100)
+    api = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}")
+    api.restore(legacy_path)
+    assert api.count_tasks() == 100
+    assert sqlite_state(tmp_path / test_db_file_name)[0] == schema_version
+
+    compact_api = TaskAPI(f"sqlite:///{tmp_path / 'compact.sqlite3'}", compact=True)
+    compact_api.add_task(Task(title="compact"))
+    compact_backup = compact_api.backup(tmp_path / "compact-backup.sqlite3")
+    with pytest.raises(BackupException):
+        api.restore(compact_backup)
+    assert api.count_tasks() == 100
+    compact_api.restore(legacy_path)
+    assert compact_api.count_tasks() == 100
+    api.close()
+    compact_api.close()
+
+
+def test_restore_corrupt_backup(tmp_path):
+    api = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}")
+    api.add_task(Task(title="kept"))
+    with pytest.raises(BackupException):
+        api.restore(tmp_path / "missing.sqlite3")
+    not_a_db = tmp_path / "not_a_db.sqlite3"
+    not_a_db.write_bytes(b"not a DB" * 1000)
+    with pytest.raises(CorruptBackup):
+        api.restore(not_a_db)
+    damaged = api.backup(tmp_path / "damaged.sqlite3")
+    data = bytearray(damaged.read_bytes())
+    data[4096:8192] = b"\xff" * 4096
+    damaged.write_bytes(data)
+    with pytest.raises(CorruptBackup):
+        api.restore(damaged)
+    assert api.count_tasks() == 1
+    api.close()
+
+
+def test_snapshots(tmp_path):
+    api = TaskAPI(f"sqlite:///{tmp_path / test_db_file_name}")
+    api.add_task(Task(title="Task"))
+    snapshot_dir = tmp_path / "backups"
+    paths = [api.snapshot(snapshot_dir, keep=3) for _ in range(5)]
+    assert list_snapshots(snapshot_dir) == paths[2:]
+
+    stop = api.start_snapshots(0.01, snapshot_dir, keep=3)
+    time.sleep(0.2)
+    stop()
+    snapshots = list_snapshots(snapshot_dir)
+    assert len(snapshots) == 3
+    assert snapshots[0] not in paths
+    api.close()
@@ -0,0 +1,148 @@
+"""Formats of TaskAPI.export_tasks() and TaskAPI.import_tasks().
+
+jsonl: one JSON object per line. csv: a header line, then one row per task.
+Both hold the task columns (transfer_columns): ids as UUID strings,
+datetimes in ISO 8601 (ones with an offset are imported in local time,
+like the app's), booleans as true / false, no completed_at as null
+(jsonl) or an empty field (csv).
+
+Rows are read and written one at a time, whatever the size of the stream.
+"""
+
+import csv
+import json
+from datetime import datetime
+from typing import Iterable, Iterator, NamedTuple, TextIO
+from uuid import UUID, uuid4
+
+transfer_formats = ("jsonl", "csv")
+# every column of the task table but list_id (tasks are imported in the
+# list of the importing TaskAPI), in the order they're exported
+transfer_columns = (
+    "id",
+    "title",
+    "is_completed",
+    "created_at",
+    "last_deferred",
+    "completed_at",
+)
+datetime_columns = ("created_at", "last_deferred", "completed_at")
+
+
+class TransferStats(NamedTuple):
+    """Rows exported or imported and how long it took."""
+
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds else float("inf")
+
+
+def export_record(row) -> dict:
+    """JSON-able dict of a row of transfer_columns."""
+    record = dict(zip(transfer_columns, row))
+    record["id"] = str(record["id"])
+    for name in datetime_columns:
+        if record[name] is not None:
+            record[name] = record[name].isoformat()
+    return record
+
+
+def write_records(stream: TextIO, format: str, rows: Iterable) -> int:
+    """Write rows of transfer_columns to stream, return how many."""
+    written = 0
+    if format == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(transfer_columns)
+        for row in rows:
+            record = export_record(row)
+            record["is_completed"] = "true" if record["is_completed"] else "false"
+            writer.writerow(record.values())
+            written += 1
+    else:
+        for row in rows:
+            stream.write(json.dumps(export_record(row), ensure_ascii=False))
+            stream.write("\n")
+            written += 1
+    return written
+
+
+def read_records(stream: TextIO, format: str) -> Iterator[tuple[int, dict]]:
+    """Yield the (line number, record) of every task in stream. A record
+    is a dict of the fields as read, see import_row().
+    """
+    if format == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"line {line_number}: invalid JSON: {e}")
+        if not isinstance(record, dict):
+            raise ValueError(f"line {line_number}: not a JSON object")
+        yield line_number, record
+
+
+def parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    if value is None or value == "":
+        return False
+    text = str(value).strip().lower()
+    if text in ("true", "1"):
+        return True
+    if text in ("false", "0"):
+        return False
+    raise ValueError(f"invalid boolean: {value!r}")
+
+
+def parse_datetime(value) -> datetime | None:
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            pass
+        else:
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone().replace(tzinfo=None)
+            return parsed
+    raise ValueError(f"invalid ISO datetime: {value!r}")
+
+
+def import_row(record: dict, now: datetime) -> dict:
+    """Row of the task table for a record read by read_records(). Its id
+    and timestamps are kept, missing ones get the same defaults as a new
+    Task (completed_at is only kept for a completed task). Raises
+    ValueError for an invalid field.
+    """
+    title = record.get("title")
+    if not title or not isinstance(title, str):
+        raise ValueError("a task must have a title (a string)")
+    id = record.get("id")
+    if id and not isinstance(id, str):
+        raise ValueError(f"invalid task id: {id!r}")
+    try:
+        id = UUID(id) if id else uuid4()
+    except ValueError:
+        raise ValueError(f"invalid task id: {id!r}")
+    is_completed = parse_bool(record.get("is_completed"))
+    completed_at = None
+    if is_completed:
+        completed_at = parse_datetime(record.get("completed_at")) or now
+    return {
+        "id": id,
+        "title": title,
+        "is_completed": is_completed,
+        "created_at": parse_datetime(record.get("created_at")) or now,
+        "last_deferred": parse_datetime(record.get("last_deferred")) or now,
+        "completed_at": completed_at,
+    }